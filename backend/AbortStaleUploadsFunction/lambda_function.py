@@ -0,0 +1,34 @@
+import os
+import boto3
+from datetime import datetime, timedelta, timezone
+from botocore.exceptions import ClientError
+
+s3_client = boto3.client('s3', region_name='eu-west-1')
+dynamodb = boto3.resource('dynamodb', region_name='eu-west-1')
+uploads_table = dynamodb.Table(os.environ.get('MEDIA_UPLOADS_TABLE', 'MediaUploads'))
+
+# Runs on a schedule and aborts multipart media uploads that were started but
+# never completed, so their parts stop accruing storage.
+def lambda_handler(event, context):
+    bucket_name = os.environ.get('MEDIA_BUCKET', 'evidence-timeline-media')
+    max_age_hours = float(os.environ.get('STALE_UPLOAD_HOURS', '24'))
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=max_age_hours)
+
+    aborted = []
+    failed = []
+    paginator = s3_client.get_paginator('list_multipart_uploads')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix='events/'):
+        for upload in page.get('Uploads', []):
+            if upload['Initiated'] > cutoff:
+                continue
+            try:
+                s3_client.abort_multipart_upload(Bucket=bucket_name, Key=upload['Key'], UploadId=upload['UploadId'])
+                uploads_table.delete_item(Key={'uploadId': upload['UploadId']})
+                aborted.append(upload['Key'])
+                print(f"Aborted stale upload {upload['UploadId']} for {upload['Key']} (initiated {upload['Initiated'].isoformat()})")
+            except ClientError as e:
+                failed.append(upload['Key'])
+                print(f"Error aborting upload {upload['UploadId']} for {upload['Key']}: {str(e)}")
+
+    print(f"Aborted {len(aborted)} stale uploads, {len(failed)} failures")
+    return {'aborted': aborted, 'failed': failed}
@@ -1,7 +1,12 @@
 import json
 import boto3
 import os
+import time
 from datetime import datetime
+from botocore.exceptions import ClientError
+from user_cache import get_user, invalidate_user
+from session_tokens import authenticate, AuthenticationError, refreshed_token_headers
+from responses import request_body
 
 dynamodb = boto3.resource('dynamodb', region_name='eu-west-1')
 users_table = dynamodb.Table('Users')
@@ -17,21 +22,8 @@ def lambda_handler(event, context):
     print("Received event:", json.dumps(event))
     print("Headers received:", json.dumps(event.get('headers', {})))
     try:
-        body = json.loads(event.get('body', '{}'))
+        body = json.loads(request_body(event))
         timeline_name = body.get('timelineName', '').strip()
-        auth_email = None
-        if event.get('headers') and isinstance(event['headers'], dict):
-            # Check for both cases
-            auth_email = event['headers'].get('X-Auth-Email', event['headers'].get('x-auth-email', '')).strip()
-            print("X-Auth-Email:", auth_email)
-        
-        if not auth_email:
-            return {
-                'statusCode': 400,
-                'body': json.dumps({'error': 'Missing X-Auth-Email header'}),
-                'headers': headers
-            }
-        
         if not timeline_name:
             return {
                 'statusCode': 400,
@@ -41,20 +33,21 @@ def lambda_handler(event, context):
         
         # Verify user exists and has correct role
         try:
-            response = users_table.get_item(Key={'email': auth_email})
-            user = response.get('Item')
-            if not user:
-                return {
-                    'statusCode': 401,
-                    'body': json.dumps({'error': 'User not found'}),
-                    'headers': headers
-                }
+            user, auth_headers = authenticate(event, users_table)
+            headers.update(auth_headers)
+            auth_email = user['email']
             if user.get('role') not in ['timeline_admin', 'super_admin']:
                 return {
                     'statusCode': 403,
                     'body': json.dumps({'error': 'Unauthorized: User does not have permission to add timelines'}),
                     'headers': headers
                 }
+        except AuthenticationError as e:
+            return {
+                'statusCode': e.status_code,
+                'body': json.dumps({'error': str(e)}),
+                'headers': headers
+            }
         except Exception as e:
             print("Error fetching user:", str(e))
             return {
@@ -63,44 +56,56 @@ def lambda_handler(event, context):
                 'headers': headers
             }
         
-        # Check if timeline already exists
+        # Create new timeline
         try:
-            response = timelines_table.get_item(Key={'timelineName': timeline_name})
-            if response.get('Item'):
+            current_time = datetime.utcnow().isoformat()
+            transact_items = [{
+                'Put': {
+                    'TableName': timelines_table.name,
+                    'Item': {
+                        'timelineName': timeline_name,
+                        'createdBy': auth_email,
+                        'createdAt': current_time,
+                        'updatedAt': current_time,
+                        # No events yet, so the summary is complete from the start
+                        'eventCount': 0,
+                        'mediaBytes': 0,
+                        'summaryBuiltAt': int(time.time())
+                    },
+                    'ConditionExpression': 'attribute_not_exists(timelineName)'
+                }
+            }]
+            grant = user.get('role') != 'super_admin'
+            if grant:
+                # The owner's grant commits with the timeline; appending keeps the
+                # write the same size however many timelines the user already has
+                transact_items.append({
+                    'Update': {
+                        'TableName': users_table.name,
+                        'Key': {'email': auth_email},
+                        'UpdateExpression': 'SET timelines = list_append(if_not_exists(timelines, :empty), :timeline), updatedAt = :now ADD permissionsVersion :one',
+                        'ConditionExpression': 'attribute_exists(email)',
+                        'ExpressionAttributeValues': {':empty': [], ':timeline': [timeline_name], ':now': current_time, ':one': 1}
+                    }
+                })
+            try:
+                dynamodb.meta.client.transact_write_items(TransactItems=transact_items)
+            except ClientError as e:
+                reasons = [reason.get('Code') for reason in e.response.get('CancellationReasons', [])]
+                if e.response['Error']['Code'] != 'TransactionCanceledException' or reasons[:1] != ['ConditionalCheckFailed']:
+                    raise
                 return {
                     'statusCode': 409,
                     'body': json.dumps({'error': 'Timeline already exists'}),
                     'headers': headers
                 }
-        except Exception as e:
-            print("Error checking timeline:", str(e))
-            return {
-                'statusCode': 500,
-                'body': json.dumps({'error': 'Failed to check timeline'}),
-                'headers': headers
-            }
-        
-        # Create new timeline
-        try:
-            current_time = datetime.utcnow().isoformat()
-            timelines_table.put_item(
-                Item={
-                    'timelineName': timeline_name,
-                    'createdAt': current_time,
-                    'updatedAt': current_time
-                }
-            )
-            
-            # Update user's timelines if not super_admin
-            if user.get('role') != 'super_admin':
-                user_timelines = user.get('timelines', [])
-                if timeline_name not in user_timelines:
-                    user_timelines.append(timeline_name)
-                    users_table.update_item(
-                        Key={'email': auth_email},
-                        UpdateExpression='SET timelines = :timelines',
-                        ExpressionAttributeValues={':timelines': user_timelines}
-                    )
+
+            if grant:
+                invalidate_user(auth_email)
+                # Hand back a token that already includes the new timeline
+                user = get_user(users_table, auth_email, refresh=True)
+                if user:
+                    headers.update(refreshed_token_headers(user))
             
             return {
                 'statusCode': 201,
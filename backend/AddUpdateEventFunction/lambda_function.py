@@ -2,16 +2,537 @@ import json
 import os
 import boto3
 import base64
+import re
+import csv
+import io
+import time
+from datetime import datetime, timezone
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from session_tokens import authenticate, AuthenticationError
+from media_refs import find_media, acquire_media, drop_reference, release_event_media
+from media_io import run_parallel, put_objects, delete_objects
+from dynamo_batch import batch_write, transact_write
+from event_sync import updated_at
+from timeline_versions import version_update
+from timeline_summary import record_changes, summary_counters, update_date_span, event_bytes
+from ulids import new_ulid
+from responses import request_body
 
 dynamodb = boto3.resource('dynamodb', region_name='eu-west-1')
 users_table = dynamodb.Table('Users')
+timelines_table = dynamodb.Table('Timelines')
+uploads_table = dynamodb.Table(os.environ.get('MEDIA_UPLOADS_TABLE', 'MediaUploads'))
+lambda_client = boto3.client('lambda', region_name='eu-west-1')
+
+# Media the browser uploads straight to S3 through presigned requests
+UPLOAD_URL_EXPIRY_SECONDS = 900
+# Media keys are never overwritten (content hash, ULID or revision suffix), so
+# browsers and CDNs can keep every object forever
+MEDIA_CACHE_CONTROL = "public, max-age=31536000, immutable"
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(100 * 1024 * 1024)))
+ORIGINAL_CONTENT_TYPES = {
+    "image/png": "png",
+    "image/jpeg": "jpeg",
+    "image/jpg": "jpg",
+    "audio/ogg": "ogg",
+    "audio/mp3": "mp3",
+    "audio/mpeg": "mp3"
+}
+CROPPED_CONTENT_TYPES = {
+    "image/png": "png",
+    "image/jpeg": "jpeg",
+    "image/jpg": "jpg"
+}
+# Uploaded keys are named by a ULID, or by the SHA-256 of the content when the
+# client supplies one so identical files are stored once
+UPLOADED_KEY_PATTERN = re.compile(r'^events/(original|cropped)/([0-9A-HJKMNP-TV-Z]{26}|[0-9a-f]{64})\.(png|jpeg|jpg|ogg|mp3)$')
+SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+def create_uploads(body, s3_client, bucket_name, headers):
+    # Returns presigned PUT URLs (or POST policies) for the requested media files.
+    # The keys are then sent as originalFileKey/croppedFileKey on POST/PUT /events.
+    # With originalSha256/croppedSha256 the key is content-addressed: files S3
+    # already has come back as {"key", "exists": true} and need no upload.
+    upload_method = body.get("uploadMethod", "PUT").upper()
+    if upload_method not in ["PUT", "POST"]:
+        return {
+            "statusCode": 400,
+            "body": json.dumps({"error": "uploadMethod must be PUT or POST"}),
+            "headers": headers
+        }
+    requested = {
+        "original": (body.get("originalContentType", ""), ORIGINAL_CONTENT_TYPES),
+        "cropped": (body.get("croppedContentType", ""), CROPPED_CONTENT_TYPES)
+    }
+    if not any(content_type for content_type, _ in requested.values()):
+        return {
+            "statusCode": 400,
+            "body": json.dumps({"error": "Missing originalContentType or croppedContentType"}),
+            "headers": headers
+        }
+
+    uploads = {}
+    for kind, (content_type, allowed) in requested.items():
+        if not content_type:
+            continue
+        content_type = content_type.split(";")[0].strip().lower()
+        if content_type not in allowed:
+            print(f"Unsupported {kind} content type:", content_type)
+            return {
+                "statusCode": 400,
+                "body": json.dumps({"error": f"Unsupported {kind} file type: {content_type}"}),
+                "headers": headers
+            }
+        content_hash = body.get(f"{kind}Sha256", "").lower()
+        if content_hash and (upload_method != "PUT" or not SHA256_PATTERN.match(content_hash)):
+            return {
+                "statusCode": 400,
+                "body": json.dumps({"error": f"{kind}Sha256 must be a hex SHA-256 and requires uploadMethod PUT"}),
+                "headers": headers
+            }
+        key = f"events/{kind}/{content_hash or new_ulid()}.{allowed[content_type]}"
+        if content_hash and find_media(key):
+            uploads[kind] = {"key": key, "exists": True}
+            print(f"Media already stored, skipping upload: {key}")
+            continue
+        if upload_method == "PUT":
+            params = {"Bucket": bucket_name, "Key": key, "ContentType": content_type, "CacheControl": MEDIA_CACHE_CONTROL}
+            upload_headers = {"Content-Type": content_type, "Cache-Control": MEDIA_CACHE_CONTROL}
+            if content_hash:
+                # S3 rejects the PUT unless the body really has this hash
+                checksum = base64.b64encode(bytes.fromhex(content_hash)).decode("utf-8")
+                params["ChecksumSHA256"] = checksum
+                upload_headers["x-amz-checksum-sha256"] = checksum
+            url = s3_client.generate_presigned_url("put_object", Params=params, ExpiresIn=UPLOAD_URL_EXPIRY_SECONDS)
+            uploads[kind] = {"key": key, "method": "PUT", "url": url, "headers": upload_headers}
+        else:
+            # POST policies can also cap the object size, which a presigned PUT cannot
+            post = s3_client.generate_presigned_post(
+                Bucket=bucket_name,
+                Key=key,
+                Fields={"Content-Type": content_type, "Cache-Control": MEDIA_CACHE_CONTROL},
+                Conditions=[{"Content-Type": content_type}, {"Cache-Control": MEDIA_CACHE_CONTROL}, ["content-length-range", 1, MAX_UPLOAD_BYTES]],
+                ExpiresIn=UPLOAD_URL_EXPIRY_SECONDS
+            )
+            uploads[kind] = {"key": key, "method": "POST", "url": post["url"], "fields": post["fields"]}
+        print(f"Presigned {upload_method} for {kind} file: {key}")
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps({"uploads": uploads, "expiresIn": UPLOAD_URL_EXPIRY_SECONDS}),
+        "headers": headers
+    }
+
+# Multipart uploads for large media (long ogg/mp3 recordings). In-progress uploads
+# are tracked in MEDIA_UPLOADS_TABLE so clients can resume them, and
+# AbortStaleUploadsFunction aborts the ones that are never completed.
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+MULTIPART_MAX_PARTS = 10000
+MULTIPART_UPLOAD_TTL_SECONDS = 24 * 60 * 60
+
+def handle_multipart(body, auth_email, user_role, s3_client, bucket_name, headers):
+    action = body.get("action", "")
+    if action == "initiate":
+        kind = body.get("kind", "original")
+        allowed = ORIGINAL_CONTENT_TYPES if kind == "original" else CROPPED_CONTENT_TYPES if kind == "cropped" else {}
+        content_type = body.get("contentType", "").split(";")[0].strip().lower()
+        if content_type not in allowed:
+            return {
+                "statusCode": 400,
+                "body": json.dumps({"error": f"Unsupported {kind} file type: {content_type}"}),
+                "headers": headers
+            }
+        key = f"events/{kind}/{new_ulid()}.{allowed[content_type]}"
+        upload_id = s3_client.create_multipart_upload(Bucket=bucket_name, Key=key, ContentType=content_type, CacheControl=MEDIA_CACHE_CONTROL)["UploadId"]
+        now = int(time.time())
+        uploads_table.put_item(Item={
+            "uploadId": upload_id,
+            "key": key,
+            "kind": kind,
+            "contentType": content_type,
+            "timelineName": body.get("timelineName", "").strip(),
+            "email": auth_email,
+            "createdAt": now,
+            "expiresAt": now + MULTIPART_UPLOAD_TTL_SECONDS
+        })
+        print(f"Initiated multipart upload {upload_id} for {key}")
+        return {
+            "statusCode": 200,
+            "body": json.dumps({"uploadId": upload_id, "key": key, "partSize": MULTIPART_PART_SIZE}),
+            "headers": headers
+        }
+
+    if action not in ["parts", "complete", "abort"]:
+        return {
+            "statusCode": 400,
+            "body": json.dumps({"error": "action must be initiate, parts, complete or abort"}),
+            "headers": headers
+        }
+
+    upload_id = body.get("uploadId", "")
+    upload = uploads_table.get_item(Key={"uploadId": upload_id}).get("Item") if upload_id else None
+    if not upload or upload["timelineName"] != body.get("timelineName", "").strip() or (upload["email"] != auth_email and user_role != "super_admin"):
+        return {
+            "statusCode": 404,
+            "body": json.dumps({"error": "Upload not found"}),
+            "headers": headers
+        }
+    key = upload["key"]
+
+    if action == "parts":
+        # Presigns the requested parts and reports the ones S3 already has, so an
+        # interrupted upload resumes where it stopped
+        part_numbers = body.get("partNumbers", [])
+        if not isinstance(part_numbers, list) or not all(isinstance(n, int) and 1 <= n <= MULTIPART_MAX_PARTS for n in part_numbers):
+            return {
+                "statusCode": 400,
+                "body": json.dumps({"error": f"partNumbers must be integers between 1 and {MULTIPART_MAX_PARTS}"}),
+                "headers": headers
+            }
+        uploaded_parts = []
+        paginator = s3_client.get_paginator("list_parts")
+        for page in paginator.paginate(Bucket=bucket_name, Key=key, UploadId=upload_id):
+            uploaded_parts.extend({"PartNumber": part["PartNumber"], "ETag": part["ETag"], "Size": part["Size"]} for part in page.get("Parts", []))
+        urls = {
+            str(part_number): s3_client.generate_presigned_url(
+                "upload_part",
+                Params={"Bucket": bucket_name, "Key": key, "UploadId": upload_id, "PartNumber": part_number},
+                ExpiresIn=UPLOAD_URL_EXPIRY_SECONDS
+            )
+            for part_number in part_numbers
+        }
+        return {
+            "statusCode": 200,
+            "body": json.dumps({"uploadId": upload_id, "key": key, "urls": urls, "uploadedParts": uploaded_parts}),
+            "headers": headers
+        }
+
+    if action == "complete":
+        parts = body.get("parts", [])
+        try:
+            parts = sorted(({"PartNumber": int(part["PartNumber"]), "ETag": str(part["ETag"])} for part in parts), key=lambda part: part["PartNumber"])
+        except (KeyError, TypeError, ValueError):
+            parts = []
+        if not parts:
+            return {
+                "statusCode": 400,
+                "body": json.dumps({"error": "Missing parts: expected [{PartNumber, ETag}]"}),
+                "headers": headers
+            }
+        s3_client.complete_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts})
+        uploads_table.delete_item(Key={"uploadId": upload_id})
+        print(f"Completed multipart upload {upload_id} for {key}")
+        return {
+            "statusCode": 200,
+            "body": json.dumps({"key": key, "fileKeyField": f"{upload['kind']}FileKey"}),
+            "headers": headers
+        }
+
+    s3_client.abort_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id)
+    uploads_table.delete_item(Key={"uploadId": upload_id})
+    print(f"Aborted multipart upload {upload_id} for {key}")
+    return {
+        "statusCode": 200,
+        "body": json.dumps({"message": "Upload aborted", "key": key}),
+        "headers": headers
+    }
+
+def revision_key(kind, event_id, extension):
+    # Base64 uploads are stored per event; the revision suffix keeps an edit from
+    # overwriting an object clients may already have cached
+    return f"events/{kind}/{event_id}-{new_ulid()[:10]}.{extension}"
+
+def uploaded_key_error(kind, key):
+    # Returns an error message, or None when the key names an upload of the right kind
+    match = UPLOADED_KEY_PATTERN.match(key)
+    allowed = ORIGINAL_CONTENT_TYPES if kind == "original" else CROPPED_CONTENT_TYPES
+    if not match or match.group(1) != kind or match.group(3) not in allowed.values():
+        return f"Invalid {kind}FileKey"
+    return None
+
+def reference_uploaded_keys(s3_client, bucket_name, keys, sizes):
+    # keys maps a kind to an uploaded key. Each key is referenced before it is
+    # checked, so neither ReconcileMediaFunction nor a delete dropping the last
+    # other reference can remove the object between the check and the write.
+    # Sizes go into sizes for the timeline summary. Returns an error message,
+    # after dropping the references again, or None.
+    acquired = []
+    for kind, key in keys.items():
+        acquire_media(key)
+        acquired.append(key)
+        try:
+            sizes[key] = s3_client.head_object(Bucket=bucket_name, Key=key)["ContentLength"]
+        except ClientError as e:
+            print(f"head_object failed for {key}: {str(e)}")
+            release_references(acquired)
+            return f"{kind}FileKey has not been uploaded"
+    return None
+
+def release_references(keys):
+    # Undoes acquire_media for a write that did not happen; objects this leaves
+    # unreferenced are removed by ReconcileMediaFunction
+    for key in keys:
+        try:
+            drop_reference(key)
+        except ClientError as e:
+            print(f"Error releasing reference to {key} (ignored): {str(e)}")
+
+# New events go through TransactWriteItems together with a condition on the
+# Timelines item, so no event lands in a timeline that is missing or being
+# deleted by DeleteTimelineFunction (which would never see it, or leave it behind)
+
+class EventWriteError(Exception):
+    # status_code is 404 for a missing event or timeline, 409 for a timeline
+    # being deleted
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+def timeline_error(timeline_name):
+    # The EventWriteError for a missing or deleting timeline, or None while it
+    # is open for writes
+    item = timelines_table.get_item(
+        Key={"timelineName": timeline_name},
+        ConsistentRead=True,
+        ProjectionExpression="timelineName, deletionStatus"
+    ).get("Item")
+    if not item or "deletionStatus" in item:
+        return timeline_closed({"Item": item})
+    return None
+
+def timeline_closed(reason):
+    if reason.get("Item"):
+        return EventWriteError(409, "Timeline is being deleted")
+    return EventWriteError(404, "Timeline not found")
+
+def put_event(table, item):
+    # The event goes in together with the Timelines update that bumps the
+    # version and adds it to the summary counters, which applies only to a live
+    # timeline. Conflicts with other writes to the Timelines item are retried.
+    timeline_update = dict(
+        version_update(item["timelineName"], summary_counters(added=[item]), live=True),
+        TableName=timelines_table.name,
+        ReturnValuesOnConditionCheckFailure="ALL_OLD"
+    )
+    try:
+        transact_write(table.meta.client, [
+            {"Put": {"TableName": table.name, "Item": item}},
+            {"Update": timeline_update}
+        ])
+    except ClientError as e:
+        reasons = e.response.get("CancellationReasons", [])
+        if reasons[1:2] and reasons[1].get("Code") == "ConditionalCheckFailed":
+            raise timeline_closed(reasons[1])
+        raise
+
+def update_event(table, event_id, timeline_name, updates):
+    # Writes only the supplied fields, only to an event of this timeline, and
+    # returns the event as it was before. The update never creates an item, so
+    # it needs no check on the timeline: an event DeleteTimelineFunction has
+    # already removed fails the condition, and one it has not is removed later
+    # together with the new media. Sets updatedAt.
+    updates["updatedAt"] = updated_at()
+    try:
+        return table.update_item(
+            Key={"eventId": event_id},
+            UpdateExpression="SET " + ", ".join(f"#{field} = :{field}" for field in updates),
+            ConditionExpression="timelineName = :timelineName AND attribute_not_exists(deleted)",
+            ExpressionAttributeNames={f"#{field}": field for field in updates},
+            ExpressionAttributeValues={**{f":{field}": value for field, value in updates.items()}, ":timelineName": timeline_name},
+            ReturnValues="ALL_OLD"
+        )["Attributes"]
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        print("Event not found or timelineName mismatch:", event_id, timeline_name)
+        raise EventWriteError(404, "Event not found or does not belong to specified timeline")
+
+def request_media_variants(event_data):
+    # Thumbnails and responsive widths are generated off the request path by ProcessMediaFunction
+    function_name = os.environ.get("PROCESS_MEDIA_FUNCTION")
+    cropped_file_key = event_data.get("croppedFileKey", "")
+    if not function_name or not cropped_file_key.lower().endswith((".png", ".jpeg", ".jpg")):
+        return
+    try:
+        lambda_client.invoke(
+            FunctionName=function_name,
+            InvocationType="Event",
+            Payload=json.dumps({"eventId": event_data["eventId"], "croppedFileKey": cropped_file_key})
+        )
+        print(f"Requested media variants for {cropped_file_key}")
+    except Exception as e:
+        print(f"Error requesting media variants for {cropped_file_key} (ignored): {str(e)}")
+
+def normalize_event_date(date):
+    # The date is the sort key of TimelineDateIndex, so store it in one
+    # lexicographically sortable form: YYYY-MM-DDTHH:MM:SS (UTC when an offset is given)
+    value = date.strip()
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed.strftime("%Y-%m-%dT%H:%M:%S")
+
+# Bulk import: {"timelineName", "format": "ndjson" | "csv", "data": "<rows>"}.
+# Each row has date and description and optionally the originalFileKey /
+# croppedFileKey of media uploaded beforehand through /events/uploads. Valid rows
+# are written with BatchWriteItem; the response has one result per row. The
+# timeline is checked before and after the writes, and DeleteTimelineFunction's
+# final pass removes rows that still land in a timeline being deleted.
+MAX_IMPORT_ROWS = 1000
+IMPORT_WORKERS = 16
+IMPORT_FIELDS = ["date", "description", "originalFileKey", "croppedFileKey"]
+
+def parse_import_rows(import_format, data):
+    if import_format == "csv":
+        return list(csv.DictReader(io.StringIO(data)))
+    rows = []
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError:
+            row = None
+        rows.append(row if isinstance(row, dict) else None)
+    return rows
+
+def stamp_updated_at(requests):
+    # Stamped per BatchWriteItem call, so a chunk sent late (or retried) is not
+    # older than sync tokens handed out while the import was running
+    now = updated_at()
+    for request in requests:
+        request["PutRequest"]["Item"]["updatedAt"] = now
+
+def import_events(body, s3_client, table, bucket_name, headers):
+    timeline_name = body.get("timelineName", "").strip()
+    import_format = body.get("format", "ndjson").lower()
+    data = body.get("data", "")
+    if not timeline_name or import_format not in ["ndjson", "csv"] or not isinstance(data, str):
+        return {
+            "statusCode": 400,
+            "body": json.dumps({"error": "Expected timelineName, format (ndjson or csv) and data"}),
+            "headers": headers
+        }
+    try:
+        rows = parse_import_rows(import_format, data.lstrip("\ufeff"))
+    except csv.Error as e:
+        return {
+            "statusCode": 400,
+            "body": json.dumps({"error": f"Invalid CSV: {str(e)}"}),
+            "headers": headers
+        }
+    if not rows or len(rows) > MAX_IMPORT_ROWS:
+        return {
+            "statusCode": 400,
+            "body": json.dumps({"error": f"Import between 1 and {MAX_IMPORT_ROWS} rows per request"}),
+            "headers": headers
+        }
+    closed = timeline_error(timeline_name)
+    if closed:
+        return {
+            "statusCode": closed.status_code,
+            "body": json.dumps({"error": str(closed)}),
+            "headers": headers
+        }
+
+    # Every distinct media key is referenced once before it is looked up (see
+    # reference_uploaded_keys), both concurrently; once the rows are written the
+    # count is corrected to the number of events that use the key
+    media_keys = {
+        ((row or {}).get(f"{kind}FileKey") or "").strip()
+        for row in rows for kind in ["original", "cropped"]
+    } - {""}
+    acquired_media, missing_media = run_parallel({
+        key: (lambda key=key: acquire_media(key))
+        for key in media_keys if UPLOADED_KEY_PATTERN.match(key)
+    }, workers=IMPORT_WORKERS)
+    found_media, missing = run_parallel({
+        key: (lambda key=key: s3_client.head_object(Bucket=bucket_name, Key=key))
+        for key in acquired_media
+    }, workers=IMPORT_WORKERS)
+    missing_media.update(missing)
+
+    results = []
+    items = {}
+    for number, row in enumerate(rows, start=1):
+        if row is None:
+            results.append({"row": number, "status": "invalid", "error": "Row is not a JSON object"})
+            continue
+        row = {field: str(row.get(field) or "").strip() for field in IMPORT_FIELDS}
+        error = None
+        if not row["date"] or not row["description"]:
+            error = "Missing required fields: date, description"
+        else:
+            try:
+                row["date"] = normalize_event_date(row["date"])
+            except ValueError:
+                error = "Invalid date: expected ISO 8601 format"
+        for kind in ["original", "cropped"]:
+            key = row[f"{kind}FileKey"]
+            if not error and key:
+                error = uploaded_key_error(kind, key)
+            if not error and key in missing_media:
+                error = f"{kind}FileKey has not been uploaded"
+        if error:
+            results.append({"row": number, "status": "invalid", "error": error})
+            continue
+        event_id = new_ulid()
+        items[event_id] = dict(row, eventId=event_id, timelineName=timeline_name)
+        for kind in ["original", "cropped"]:
+            if row[f"{kind}FileKey"]:
+                items[event_id][f"{kind}FileSize"] = found_media[row[f"{kind}FileKey"]]["ContentLength"]
+        results.append({"row": number, "status": "created", "eventId": event_id})
+
+    unprocessed = batch_write(table, [{"PutRequest": {"Item": item}} for item in items.values()], before_send=stamp_updated_at)
+    failed_ids = {request["PutRequest"]["Item"]["eventId"] for request in unprocessed}
+    for result in results:
+        if result.get("eventId") in failed_ids:
+            result.update(status="failed", error="Write was throttled, retry this row")
+            del result["eventId"]
+
+    written = [item for event_id, item in items.items() if event_id not in failed_ids]
+    uses = {key: 0 for key in acquired_media}
+    for item in written:
+        for kind in ["original", "cropped"]:
+            if item[f"{kind}FileKey"]:
+                uses[item[f"{kind}FileKey"]] += 1
+    # One reference per event; keys no written row uses give theirs back
+    _, reference_errors = run_parallel({
+        key: (lambda key=key, count=count: acquire_media(key, count - 1) if count else drop_reference(key))
+        for key, count in uses.items() if count != 1
+    }, workers=IMPORT_WORKERS)
+    for key, error in reference_errors.items():
+        print(f"Error correcting references to {key}: {error}")
+    if written:
+        record_changes(timelines_table, table, timeline_name, added=written)
+
+    closed = timeline_error(timeline_name)
+    if closed:
+        # Deleted meanwhile; the deletion job removes the rows and their media
+        print(f"Import into {timeline_name} raced its deletion: {str(closed)}")
+        return {
+            "statusCode": closed.status_code,
+            "body": json.dumps({"error": str(closed)}),
+            "headers": headers
+        }
+    run_parallel({item["eventId"]: (lambda item=item: request_media_variants(item)) for item in written}, workers=IMPORT_WORKERS)
+
+    counts = {status: sum(1 for result in results if result["status"] == status) for status in ["created", "invalid", "failed"]}
+    print(f"Imported {counts['created']} events into {timeline_name} ({counts['invalid']} invalid, {counts['failed']} failed)")
+    return {
+        "statusCode": 200,
+        "body": json.dumps({"results": results, **counts}),
+        "headers": headers
+    }
 
 def lambda_handler(event, context):
     headers = {
         "Content-Type": "application/json",
         "Access-Control-Allow-Origin": "*",
-        "Access-Control-Allow-Methods": "POST,PUT,OPTIONS",
+        "Access-Control-Allow-Methods": "POST,PUT,PATCH,OPTIONS",
         "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token,X-Auth-Email"
     }
     
@@ -21,46 +542,26 @@ def lambda_handler(event, context):
         path_parameters = event.get("pathParameters", {}) or {}
         event_id = path_parameters.get("eventId", None)
         
-        # Validate X-Auth-Email header (case-insensitive)
-        auth_email = None
-        if event.get('headers') and isinstance(event['headers'], dict):
-            auth_email = event['headers'].get('X-Auth-Email', event['headers'].get('x-auth-email', '')).strip()
-        if not auth_email:
-            print("Missing X-Auth-Email header")
-            return {
-                "statusCode": 400,
-                "body": json.dumps({"error": "Missing X-Auth-Email header"}),
-                "headers": headers
-            }
-
-        # Fetch user details
         try:
-            user_response = users_table.get_item(Key={'email': auth_email})
-            user = user_response.get('Item')
-            if not user:
-                print("User not found for email:", auth_email)
-                return {
-                    "statusCode": 401,
-                    "body": json.dumps({"error": "User not found"}),
-                    "headers": headers
-                }
-            user_role = user.get('role', 'viewer')
-            user_timelines = user.get('timelines', [])
-        except ClientError as e:
-            print(f"Error fetching user: {str(e)}")
+            user, auth_headers = authenticate(event, users_table)
+        except AuthenticationError as e:
             return {
-                "statusCode": 500,
-                "body": json.dumps({"error": f"Failed to fetch user: {str(e)}"}),
+                "statusCode": e.status_code,
+                "body": json.dumps({"error": str(e)}),
                 "headers": headers
             }
+        headers.update(auth_headers)
+        auth_email = user["email"]
+        user_role = user.get('role', 'viewer')
+        user_timelines = user.get('timelines', [])
 
         # Handle Lambda Proxy payload
         if "body" in event:
-            body_str = event.get("body", "{}")
-            print("Raw body:", body_str)
             try:
+                body_str = request_body(event)
+                print("Raw body:", body_str)
                 body = json.loads(body_str)
-            except json.JSONDecodeError as e:
+            except ValueError as e:
                 print("JSON decode error:", str(e))
                 return {
                     "statusCode": 400,
@@ -92,11 +593,11 @@ def lambda_handler(event, context):
             }
         
         dynamodb = boto3.resource("dynamodb", region_name="eu-west-1")
-        s3_client = boto3.client("s3", region_name="eu-west-1")
+        s3_client = boto3.client("s3", region_name="eu-west-1", config=Config(signature_version="s3v4", s3={"addressing_style": "virtual"}))
         table = dynamodb.Table(table_name)
         
-        # Role-based access control for POST and PUT
-        if http_method in ["POST", "PUT"]:
+        # Role-based access control for POST, PUT and PATCH
+        if http_method in ["POST", "PUT", "PATCH"]:
             timeline_name = body.get("timelineName", "").strip()
             if user_role == 'viewer':
                 print(f"User {auth_email} is a viewer, cannot modify events")
@@ -113,6 +614,28 @@ def lambda_handler(event, context):
                     "headers": headers
                 }
 
+        path = event.get("resource") or event.get("path") or ""
+        if http_method == "POST" and path.rstrip("/").endswith("/events/import"):
+            return import_events(body, s3_client, table, bucket_name, headers)
+
+        if http_method == "POST" and path.rstrip("/").endswith("/uploads/multipart"):
+            if not body.get("timelineName", "").strip():
+                return {
+                    "statusCode": 400,
+                    "body": json.dumps({"error": "Missing timelineName"}),
+                    "headers": headers
+                }
+            return handle_multipart(body, auth_email, user_role, s3_client, bucket_name, headers)
+
+        if http_method == "POST" and path.rstrip("/").endswith("/uploads"):
+            if not body.get("timelineName", "").strip():
+                return {
+                    "statusCode": 400,
+                    "body": json.dumps({"error": "Missing timelineName"}),
+                    "headers": headers
+                }
+            return create_uploads(body, s3_client, bucket_name, headers)
+
         if http_method == "POST":
             date = body.get("date", "")
             description = body.get("description", "")
@@ -127,8 +650,17 @@ def lambda_handler(event, context):
                     "body": json.dumps({"error": "Missing required fields: date, description, timelineName"}),
                     "headers": headers
                 }
+            try:
+                date = normalize_event_date(date)
+            except ValueError:
+                print("Invalid date:", date)
+                return {
+                    "statusCode": 400,
+                    "body": json.dumps({"error": "Invalid date: expected ISO 8601 format"}),
+                    "headers": headers
+                }
             
-            event_id = str(context.aws_request_id)
+            event_id = new_ulid()
             event_data = {
                 "eventId": event_id,
                 "date": date,
@@ -138,6 +670,23 @@ def lambda_handler(event, context):
                 "croppedFileKey": ""
             }
             
+            # Record media uploaded directly to S3 through presigned requests
+            uploaded_keys = {}
+            for kind in ["original", "cropped"]:
+                uploaded_key = body.get(f"{kind}FileKey", "")
+                if not uploaded_key:
+                    continue
+                error = uploaded_key_error(kind, uploaded_key)
+                if error or body.get(f"{kind}File"):
+                    return {
+                        "statusCode": 400,
+                        "body": json.dumps({"error": error or f"Send either {kind}File or {kind}FileKey, not both"}),
+                        "headers": headers
+                    }
+                event_data[f"{kind}FileKey"] = uploaded_key
+                uploaded_keys[kind] = uploaded_key
+            media_sizes = {}
+            
             # Handle file uploads to S3
             if original_file_data or cropped_file_data:
                 try:
@@ -148,6 +697,7 @@ def lambda_handler(event, context):
                             "body": json.dumps({"error": "Empty file data"}),
                             "headers": headers
                         }
+                    media_puts = []
                     # Process original file
                     original_file_key = ""
                     if original_file_data:
@@ -176,16 +726,16 @@ def lambda_handler(event, context):
                                 "body": json.dumps({"error": f"Unsupported original file type: {file_extension}"}),
                                 "headers": headers
                             }
-                        original_file_key = f"events/original/{event_id}.{file_extension}"
+                        original_file_key = revision_key("original", event_id, file_extension)
                         print(f"Uploading original file to S3: {original_file_key}, ContentType: {mime_type.split(';')[0]}")
-                        s3_client.put_object(
-                            Bucket=bucket_name,
-                            Key=original_file_key,
-                            Body=file_content,
-                            ContentType=mime_type.split(";")[0]
-                        )
+                        media_puts.append({
+                            "Key": original_file_key,
+                            "Body": file_content,
+                            "ContentType": mime_type.split(";")[0],
+                            "CacheControl": MEDIA_CACHE_CONTROL
+                        })
                         event_data["originalFileKey"] = original_file_key
-                        print(f"Uploaded original file to S3: {original_file_key}")
+                        media_sizes[original_file_key] = len(file_content)
                     
                     # Process cropped file
                     cropped_file_key = ""
@@ -215,16 +765,26 @@ def lambda_handler(event, context):
                                 "body": json.dumps({"error": f"Unsupported cropped file type: {file_extension}"}),
                                 "headers": headers
                             }
-                        cropped_file_key = f"events/cropped/{event_id}.{file_extension}"
+                        cropped_file_key = revision_key("cropped", event_id, file_extension)
                         print(f"Uploading cropped file to S3: {cropped_file_key}, ContentType: {mime_type.split(';')[0]}")
-                        s3_client.put_object(
-                            Bucket=bucket_name,
-                            Key=cropped_file_key,
-                            Body=file_content,
-                            ContentType=mime_type.split(";")[0]
-                        )
+                        media_puts.append({
+                            "Key": cropped_file_key,
+                            "Body": file_content,
+                            "ContentType": mime_type.split(";")[0],
+                            "CacheControl": MEDIA_CACHE_CONTROL
+                        })
                         event_data["croppedFileKey"] = cropped_file_key
-                        print(f"Uploaded cropped file to S3: {cropped_file_key}")
+                        media_sizes[cropped_file_key] = len(file_content)
+
+                    # Original and cropped go up concurrently
+                    failed_uploads = put_objects(s3_client, bucket_name, media_puts)
+                    if failed_uploads:
+                        return {
+                            "statusCode": 500,
+                            "body": json.dumps({"error": "S3 upload error", "failedFiles": failed_uploads}),
+                            "headers": headers
+                        }
+                    print(f"Uploaded {len(media_puts)} files to S3")
                 except Exception as e:
                     print("S3 upload error:", str(e))
                     return {
@@ -233,15 +793,40 @@ def lambda_handler(event, context):
                         "headers": headers
                     }
             
+            error = reference_uploaded_keys(s3_client, bucket_name, uploaded_keys, media_sizes)
+            if error:
+                return {
+                    "statusCode": 400,
+                    "body": json.dumps({"error": error}),
+                    "headers": headers
+                }
+            for kind in ["original", "cropped"]:
+                if event_data[f"{kind}FileKey"]:
+                    event_data[f"{kind}FileSize"] = media_sizes[event_data[f"{kind}FileKey"]]
             print("Saving event:", event_data)
-            table.put_item(Item=event_data)
+            event_data["updatedAt"] = updated_at()
+            try:
+                put_event(table, event_data)
+            except EventWriteError as e:
+                release_references(uploaded_keys.values())
+                return {
+                    "statusCode": e.status_code,
+                    "body": json.dumps({"error": str(e)}),
+                    "headers": headers
+                }
+            except Exception:
+                release_references(uploaded_keys.values())
+                raise
+            # The counters went out with the event; only the date span is left
+            update_date_span(timelines_table, table, timeline_name, None, added=[event_data])
+            request_media_variants(event_data)
             return {
                 "statusCode": 200,
                 "body": json.dumps({"message": "Event added", "event": event_data}),
                 "headers": headers
             }
         
-        elif http_method == "PUT":
+        elif http_method in ["PUT", "PATCH"]:
             if not event_id:
                 print("Missing eventId")
                 return {
@@ -255,82 +840,57 @@ def lambda_handler(event, context):
             original_file_data = body.get("originalFile", "")
             cropped_file_data = body.get("croppedFile", "")
             
-            if not date or not description or not timeline_name:
+            if http_method == "PUT" and (not date or not description or not timeline_name):
                 print("Missing required fields")
                 return {
                     "statusCode": 400,
                     "body": json.dumps({"error": "Missing required fields: date, description, timelineName"}),
                     "headers": headers
                 }
+            if http_method == "PATCH":
+                # PATCH only touches the fields it is given and never media
+                if any(body.get(field) for field in ["originalFile", "croppedFile", "originalFileKey", "croppedFileKey"]):
+                    return {
+                        "statusCode": 400,
+                        "body": json.dumps({"error": "PATCH cannot change media, use PUT"}),
+                        "headers": headers
+                    }
+                if not timeline_name or not (date or description):
+                    return {
+                        "statusCode": 400,
+                        "body": json.dumps({"error": "PATCH needs timelineName and at least one of date, description"}),
+                        "headers": headers
+                    }
+            updates = {}
+            if date:
+                try:
+                    updates["date"] = normalize_event_date(date)
+                except ValueError:
+                    print("Invalid date:", date)
+                    return {
+                        "statusCode": 400,
+                        "body": json.dumps({"error": "Invalid date: expected ISO 8601 format"}),
+                        "headers": headers
+                    }
+            if description:
+                updates["description"] = description
             
-            # Fetch existing event
-            print(f"Fetching existing event: {event_id}")
-            response = table.get_item(Key={"eventId": event_id})
-            item = response.get("Item")
-            if not item or item.get("timelineName") != timeline_name:
-                print("Event not found or timelineName mismatch:", event_id, timeline_name)
-                return {
-                    "statusCode": 404,
-                    "body": json.dumps({"error": "Event not found or does not belong to specified timeline"}),
-                    "headers": headers
-                }
-            old_original_file_key = item.get("originalFileKey", "")
-            old_cropped_file_key = item.get("croppedFileKey", "")
-            
-            event_data = {
-                "eventId": event_id,
-                "date": date,
-                "description": description,
-                "timelineName": timeline_name,
-                "originalFileKey": old_original_file_key,
-                "croppedFileKey": old_cropped_file_key
-            }
-            
-            # Clean up unreferenced S3 files
-            try:
-                # List all files with event_id prefix in original and cropped folders
-                original_files = s3_client.list_objects_v2(
-                    Bucket=bucket_name,
-                    Prefix=f"events/original/{event_id}."
-                ).get("Contents", [])
-                cropped_files = s3_client.list_objects_v2(
-                    Bucket=bucket_name,
-                    Prefix=f"events/cropped/{event_id}."
-                ).get("Contents", [])
-                
-                # Determine new file keys
-                new_original_file_key = old_original_file_key
-                new_cropped_file_key = old_cropped_file_key
-                if original_file_data:
-                    mime_type = original_file_data.split(",")[0]
-                    file_extension = mime_type.split("/")[1].split(";")[0]
-                    new_original_file_key = f"events/original/{event_id}.{file_extension}"
-                if cropped_file_data:
-                    mime_type = cropped_file_data.split(",")[0]
-                    file_extension = mime_type.split("/")[1].split(";")[0]
-                    new_cropped_file_key = f"events/cropped/{event_id}.{file_extension}"
-                
-                # Delete unreferenced original files
-                for obj in original_files:
-                    key = obj["Key"]
-                    if key != new_original_file_key and key != old_original_file_key:
-                        try:
-                            s3_client.delete_object(Bucket=bucket_name, Key=key)
-                            print(f"Deleted unreferenced original file: {key}")
-                        except Exception as e:
-                            print(f"Error deleting unreferenced original file {key} (ignored): {str(e)}")
-                
-                # Delete unreferenced cropped files
-                for obj in cropped_files:
-                    key = obj["Key"]
-                    if key != new_cropped_file_key and key != old_cropped_file_key:
-                        try:
-                            s3_client.delete_object(Bucket=bucket_name, Key=key)
-                            print(f"Deleted unreferenced cropped file: {key}")
-                        except Exception as e:
-                            print(f"Error deleting unreferenced cropped file {key} (ignored): {str(e)}")
-            except Exception as e:
-                print(f"Error listing or deleting unreferenced S3 files (ignored): {str(e)}")
+            # Record media uploaded directly to S3 through presigned requests
+            uploaded_keys = {}
+            for kind in ["original", "cropped"]:
+                uploaded_key = body.get(f"{kind}FileKey", "") if http_method == "PUT" else ""
+                if not uploaded_key:
+                    continue
+                error = uploaded_key_error(kind, uploaded_key)
+                if error or body.get(f"{kind}File"):
+                    return {
+                        "statusCode": 400,
+                        "body": json.dumps({"error": error or f"Send either {kind}File or {kind}FileKey, not both"}),
+                        "headers": headers
+                    }
+                updates[f"{kind}FileKey"] = uploaded_key
+                uploaded_keys[kind] = uploaded_key
+            media_sizes = {}
             
             # Handle file uploads to S3
             if original_file_data or cropped_file_data:
@@ -342,6 +902,7 @@ def lambda_handler(event, context):
                             "body": json.dumps({"error": "Empty file data"}),
                             "headers": headers
                         }
+                    media_puts = []
                     # Process original file
                     if original_file_data:
                         if not original_file_data.startswith("data:") or ";base64," not in original_file_data:
@@ -369,16 +930,16 @@ def lambda_handler(event, context):
                                 "body": json.dumps({"error": f"Unsupported original file type: {file_extension}"}),
                                 "headers": headers
                             }
-                        original_file_key = f"events/original/{event_id}.{file_extension}"
+                        original_file_key = revision_key("original", event_id, file_extension)
                         print(f"Uploading original file to S3: {original_file_key}, ContentType: {mime_type.split(';')[0]}")
-                        s3_client.put_object(
-                            Bucket=bucket_name,
-                            Key=original_file_key,
-                            Body=file_content,
-                            ContentType=mime_type.split(";")[0]
-                        )
-                        event_data["originalFileKey"] = original_file_key
-                        print(f"Uploaded original file to S3: {original_file_key}")
+                        media_puts.append({
+                            "Key": original_file_key,
+                            "Body": file_content,
+                            "ContentType": mime_type.split(";")[0],
+                            "CacheControl": MEDIA_CACHE_CONTROL
+                        })
+                        updates["originalFileKey"] = original_file_key
+                        media_sizes[original_file_key] = len(file_content)
                     
                     # Process cropped file
                     if cropped_file_data:
@@ -407,16 +968,26 @@ def lambda_handler(event, context):
                                 "body": json.dumps({"error": f"Unsupported cropped file type: {file_extension}"}),
                                 "headers": headers
                             }
-                        cropped_file_key = f"events/cropped/{event_id}.{file_extension}"
+                        cropped_file_key = revision_key("cropped", event_id, file_extension)
                         print(f"Uploading cropped file to S3: {cropped_file_key}, ContentType: {mime_type.split(';')[0]}")
-                        s3_client.put_object(
-                            Bucket=bucket_name,
-                            Key=cropped_file_key,
-                            Body=file_content,
-                            ContentType=mime_type.split(";")[0]
-                        )
-                        event_data["croppedFileKey"] = cropped_file_key
-                        print(f"Uploaded cropped file to S3: {cropped_file_key}")
+                        media_puts.append({
+                            "Key": cropped_file_key,
+                            "Body": file_content,
+                            "ContentType": mime_type.split(";")[0],
+                            "CacheControl": MEDIA_CACHE_CONTROL
+                        })
+                        updates["croppedFileKey"] = cropped_file_key
+                        media_sizes[cropped_file_key] = len(file_content)
+
+                    # Original and cropped go up concurrently
+                    failed_uploads = put_objects(s3_client, bucket_name, media_puts)
+                    if failed_uploads:
+                        return {
+                            "statusCode": 500,
+                            "body": json.dumps({"error": "S3 upload error", "failedFiles": failed_uploads}),
+                            "headers": headers
+                        }
+                    print(f"Uploaded {len(media_puts)} files to S3")
                 except Exception as e:
                     print("S3 upload error:", str(e))
                     return {
@@ -425,21 +996,87 @@ def lambda_handler(event, context):
                         "headers": headers
                     }
             
-            print("Updating event:", event_data)
+            error = reference_uploaded_keys(s3_client, bucket_name, uploaded_keys, media_sizes)
+            if error:
+                return {
+                    "statusCode": 400,
+                    "body": json.dumps({"error": error}),
+                    "headers": headers
+                }
+            for kind in ["original", "cropped"]:
+                if f"{kind}FileKey" in updates:
+                    updates[f"{kind}FileSize"] = media_sizes[updates[f"{kind}FileKey"]]
+            print(f"Updating event {event_id}:", updates)
+            # Only the supplied fields are written, and only to an event of this
+            # timeline; the event as it was before says what the update replaced
             try:
-                table.put_item(Item=event_data)
-                print(f"Successfully updated event in DynamoDB: {event_id}")
+                old_values = update_event(table, event_id, timeline_name, updates)
+            except EventWriteError as e:
+                release_references(uploaded_keys.values())
+                return {
+                    "statusCode": e.status_code,
+                    "body": json.dumps({"error": str(e)}),
+                    "headers": headers
+                }
             except ClientError as e:
-                print("DynamoDB put_item error:", str(e))
+                release_references(uploaded_keys.values())
+                print("DynamoDB update error:", str(e))
                 return {
                     "statusCode": 500,
                     "body": json.dumps({"error": f"DynamoDB error: {str(e)}"}),
                     "headers": headers
                 }
+            print(f"Successfully updated event in DynamoDB: {event_id}")
+            
+            replaced = {
+                kind: old_values.get(f"{kind}FileKey", "")
+                for kind in ["original", "cropped"]
+                if f"{kind}FileKey" in updates and updates[f"{kind}FileKey"] != old_values.get(f"{kind}FileKey", "")
+            }
+            try:
+                # The new media was referenced before the write; a key the event
+                # already had holds a reference of its own, so drop the extra one
+                release_references(key for kind, key in uploaded_keys.items() if kind not in replaced)
+                old_variants = []
+                if "cropped" in replaced:
+                    # Variants stay valid only while the cropped image itself is unchanged
+                    try:
+                        old_variants = table.update_item(
+                            Key={"eventId": event_id},
+                            UpdateExpression="SET updatedAt = :updatedAt REMOVE mediaVariants",
+                            ConditionExpression="croppedFileKey = :key",
+                            ExpressionAttributeValues={":key": updates["croppedFileKey"], ":updatedAt": updated_at()},
+                            ReturnValues="UPDATED_OLD"
+                        ).get("Attributes", {}).get("mediaVariants", [])
+                        request_media_variants({"eventId": event_id, "croppedFileKey": updates["croppedFileKey"]})
+                    except ClientError as e:
+                        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                            raise
+                        print(f"Cropped image of {event_id} changed again meanwhile, variants left to that update")
+                try:
+                    unreferenced = release_event_media({
+                        "originalFileKey": replaced.get("original"),
+                        "croppedFileKey": replaced.get("cropped"),
+                        "mediaVariants": old_variants
+                    })
+                except Exception as e:
+                    print(f"Error releasing replaced files of {event_id} (ignored): {str(e)}")
+                    unreferenced = []
+                # Failures are left for ReconcileMediaFunction
+                delete_objects(s3_client, bucket_name, unreferenced)
+            except ClientError as e:
+                print("Error updating media references (ignored):", str(e))
             
+            # Last, so a failed version bump fails the request only after the
+            # replaced media is released
+            new_values = {**old_values, **updates}
+            if new_values["date"] != old_values["date"] or event_bytes(new_values) != event_bytes(old_values):
+                record_changes(timelines_table, table, timeline_name, added=[new_values], removed=[old_values])
+            else:
+                record_changes(timelines_table, table, timeline_name)
             return {
                 "statusCode": 200,
-                "body": json.dumps({"message": "Event updated", "event": event_data}),
+                "body": json.dumps({"message": "Event updated", "event": {"eventId": event_id, "timelineName": timeline_name, **updates}}),
                 "headers": headers
             }
         
@@ -0,0 +1,59 @@
+import os
+from datetime import datetime
+import boto3
+from botocore.exceptions import ClientError
+
+dynamodb = boto3.resource('dynamodb', region_name='eu-west-1')
+users_table = dynamodb.Table(os.environ.get('USERS_TABLE', 'Users'))
+usernames_table = dynamodb.Table(os.environ.get('USERNAMES_TABLE', 'Usernames'))
+
+def claim_username(user):
+    # Returns 'created', 'existing' (already held by this user) or 'conflict'
+    try:
+        usernames_table.put_item(
+            Item={
+                'username': user['username'],
+                'email': user['email'],
+                'createdAt': user.get('createdAt') or datetime.utcnow().isoformat()
+            },
+            ConditionExpression='attribute_not_exists(username)'
+        )
+        return 'created'
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+    holder = usernames_table.get_item(Key={'username': user['username']}, ConsistentRead=True).get('Item') or {}
+    return 'existing' if holder.get('email') == user['email'] else 'conflict'
+
+# Writes the Usernames item RegisterFunction relies on for every user registered
+# before that table existed. Safe to run any number of times; usernames held by
+# more than one user are reported rather than reassigned. Once it has run
+# without failures, RegisterFunction no longer needs its UsernameIndex query:
+# deploy it with USERNAME_INDEX_CHECK set to "false".
+def lambda_handler(event, context):
+    report = {'created': 0, 'existing': 0, 'conflicts': [], 'failed': []}
+    scan_kwargs = {
+        'ProjectionExpression': 'email, username, createdAt',
+        'FilterExpression': 'attribute_exists(username)'
+    }
+    while True:
+        response = users_table.scan(**scan_kwargs)
+        for user in response.get('Items', []):
+            if not user.get('username'):
+                continue
+            try:
+                outcome = claim_username(user)
+            except ClientError as e:
+                print(f"Error backfilling username of {user['email']}: {str(e)}")
+                report['failed'].append(user['email'])
+                continue
+            if outcome == 'conflict':
+                print(f"Username {user['username']} of {user['email']} is held by another user")
+                report['conflicts'].append({'username': user['username'], 'email': user['email']})
+            else:
+                report[outcome] += 1
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    print(f"Backfilled {report['created']} usernames ({report['existing']} already present, {len(report['conflicts'])} conflicts, {len(report['failed'])} failed)")
+    return report
@@ -2,12 +2,89 @@ import json
 import os
 import boto3
 from botocore.exceptions import ClientError
+from session_tokens import authenticate, AuthenticationError
+from media_refs import release_event_media
+from media_io import run_parallel, delete_objects
+from event_sync import tombstone
+from timeline_summary import record_changes
+from responses import request_body
 
 dynamodb = boto3.resource('dynamodb', region_name='eu-west-1')
 s3_client = boto3.client('s3', region_name='eu-west-1')
 users_table = dynamodb.Table('Users')
+timelines_table = dynamodb.Table('Timelines')
 table = dynamodb.Table('TimelineEvents')
 
+MAX_BULK_DELETE = 1000
+BULK_DELETE_WORKERS = 16
+
+def delete_event(event_id, timeline_name):
+    # Replaces the event with a tombstone so delta sync can report the delete.
+    # The condition checks it belongs to the timeline and is not deleted yet, and
+    # the old item says which media this delete releases, so a repeated or
+    # concurrent delete never releases it twice. Returns the old item, or None
+    # when there was no such event. Bulk deletes call this on a thread pool, so
+    # it goes through the low-level client: the Table resource is not thread-safe.
+    try:
+        return table.meta.client.put_item(
+            TableName=table.name,
+            Item=tombstone(event_id, timeline_name),
+            ConditionExpression='timelineName = :tn AND attribute_not_exists(deleted)',
+            ExpressionAttributeValues={':tn': timeline_name},
+            ReturnValues='ALL_OLD'
+        )['Attributes']
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return None
+        raise
+
+def delete_events(event_ids, timeline_name, bucket_name, headers):
+    # Bulk delete: one conditional tombstone put per event on a thread pool, then
+    # one DeleteObjects for the media nothing references any more. Only events
+    # whose own put succeeded release media. Every ID gets its own outcome.
+    # BatchGetItem + BatchWriteItem would take fewer calls, but BatchWriteItem
+    # has no conditions and returns no old items, so a delete racing another
+    # one could release the same media twice; the per-item puts are what make
+    # the release exact. Up to MAX_BULK_DELETE puts plus two MediaIndex updates
+    # per event is why the function's Timeout is raised in template.yaml.
+    old_items, errors = run_parallel(
+        {event_id: (lambda event_id=event_id: delete_event(event_id, timeline_name)) for event_id in event_ids},
+        workers=BULK_DELETE_WORKERS
+    )
+    outcomes = {}
+    for event_id in event_ids:
+        if event_id in errors:
+            print(f"Error deleting {event_id}: {errors[event_id]}")
+            outcomes[event_id] = 'failed'
+        else:
+            outcomes[event_id] = 'deleted' if old_items[event_id] else 'not_found'
+    items = [item for item in old_items.values() if item]
+    released, release_errors = run_parallel(
+        {item['eventId']: (lambda item=item: release_event_media(item)) for item in items},
+        workers=BULK_DELETE_WORKERS
+    )
+    for event_id, error in release_errors.items():
+        # The event is gone either way; ReconcileMediaFunction picks up its media
+        print(f"Error releasing media of {event_id} (ignored): {error}")
+    unreferenced = [key for keys in released.values() for key in keys]
+    deleted_files, failed_files = delete_objects(s3_client, bucket_name, unreferenced)
+    # Last, so a failed version bump fails the request only after the media is released
+    if items:
+        record_changes(timelines_table, table, timeline_name, removed=items)
+
+    counts = {outcome: sum(1 for value in outcomes.values() if value == outcome) for outcome in ['deleted', 'not_found', 'failed']}
+    print(f"Bulk delete in {timeline_name}: {counts}, {len(deleted_files)} S3 objects deleted, {len(failed_files)} failures")
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'results': outcomes,
+            **counts,
+            'deletedFiles': deleted_files,
+            'failedFiles': sorted(failed_files)
+        }),
+        'headers': headers
+    }
+
 def lambda_handler(event, context):
     headers = {
         'Content-Type': 'application/json',
@@ -17,48 +94,45 @@ def lambda_handler(event, context):
     }
 
     try:
-        # Validate X-Auth-Email header (case-insensitive)
-        auth_email = None
-        if event.get('headers') and isinstance(event['headers'], dict):
-            auth_email = event['headers'].get('X-Auth-Email', event['headers'].get('x-auth-email', '')).strip()
-        if not auth_email:
-            print("Missing X-Auth-Email header")
-            return {
-                'statusCode': 400,
-                'body': json.dumps({'error': 'Missing X-Auth-Email header'}),
-                'headers': headers
-            }
-
-        # Fetch user details
         try:
-            user_response = users_table.get_item(Key={'email': auth_email})
-            user = user_response.get('Item')
-            if not user:
-                print("User not found for email:", auth_email)
-                return {
-                    'statusCode': 401,
-                    'body': json.dumps({'error': 'User not found'}),
-                    'headers': headers
-                }
-            user_role = user.get('role', 'viewer')
-            user_timelines = user.get('timelines', [])
-        except ClientError as e:
-            print(f"Error fetching user: {str(e)}")
+            user, auth_headers = authenticate(event, users_table)
+        except AuthenticationError as e:
             return {
-                'statusCode': 500,
-                'body': json.dumps({'error': f'Failed to fetch user: {str(e)}'}),
+                'statusCode': e.status_code,
+                'body': json.dumps({'error': str(e)}),
                 'headers': headers
             }
+        headers.update(auth_headers)
+        auth_email = user['email']
+        user_role = user.get('role', 'viewer')
+        user_timelines = user.get('timelines', [])
 
-        path_params = event.get('pathParameters', {})
+        path_params = event.get('pathParameters') or {}
         query_params = event.get('queryStringParameters', {}) or {}
         event_id = path_params.get('eventId')
         timeline_name = query_params.get('timelineName')
 
-        if not event_id or not timeline_name:
+        # DELETE /events takes {"eventIds": [...]} instead of a single path eventId
+        event_ids = None
+        if not event_id:
+            try:
+                event_ids = json.loads(request_body(event) or '{}').get('eventIds')
+            except (ValueError, AttributeError):
+                event_ids = None
+            if not isinstance(event_ids, list) or not all(isinstance(value, str) and value for value in event_ids):
+                event_ids = None
+            else:
+                event_ids = list(dict.fromkeys(event_ids))
+        if not (event_id or event_ids) or not timeline_name:
             return {
                 'statusCode': 400,
-                'body': json.dumps({'error': 'Missing eventId or timelineName'}),
+                'body': json.dumps({'error': 'Missing eventId (or eventIds) or timelineName'}),
+                'headers': headers
+            }
+        if event_ids and len(event_ids) > MAX_BULK_DELETE:
+            return {
+                'statusCode': 400,
+                'body': json.dumps({'error': f'At most {MAX_BULK_DELETE} eventIds per request'}),
                 'headers': headers
             }
 
@@ -78,15 +152,6 @@ def lambda_handler(event, context):
                 'headers': headers
             }
 
-        # Verify event exists and belongs to timeline
-        response = table.get_item(Key={'eventId': event_id}).get('Item')
-        if not response or response.get('timelineName') != timeline_name:
-            return {
-                'statusCode': 404,
-                'body': json.dumps({'error': 'Event not found or does not belong to specified timeline'}),
-                'headers': headers
-            }
-
         # Get S3 bucket name from environment variable
         bucket_name = os.environ.get('MEDIA_BUCKET', 'evidence-timeline-media')
         if not bucket_name:
@@ -97,52 +162,48 @@ def lambda_handler(event, context):
                 'headers': headers
             }
 
-        # Delete associated S3 files
-        original_file_key = response.get('originalFileKey', '')
-        cropped_file_key = response.get('croppedFileKey', '')
-        deleted_files = []
+        if event_ids:
+            return delete_events(event_ids, timeline_name, bucket_name, headers)
 
         try:
-            # Delete original file if it exists
-            if original_file_key:
-                print(f"Deleting S3 object: {original_file_key}")
-                s3_client.delete_object(Bucket=bucket_name, Key=original_file_key)
-                deleted_files.append(original_file_key)
-                print(f"Successfully deleted S3 object: {original_file_key}")
-
-            # Delete cropped file if it exists
-            if cropped_file_key:
-                print(f"Deleting S3 object: {cropped_file_key}")
-                s3_client.delete_object(Bucket=bucket_name, Key=cropped_file_key)
-                deleted_files.append(cropped_file_key)
-                print(f"Successfully deleted S3 object: {cropped_file_key}")
+            response = delete_event(event_id, timeline_name)
         except ClientError as e:
-            print(f"Error deleting S3 objects: {str(e)}")
-            # Log error but proceed with DynamoDB deletion
+            print(f"Error deleting event from DynamoDB: {str(e)}")
             return {
                 'statusCode': 500,
-                'body': json.dumps({'error': f'Failed to delete S3 objects: {str(e)}. Proceeding with DynamoDB deletion.'}),
+                'body': json.dumps({'error': f'Failed to delete event from DynamoDB: {str(e)}'}),
                 'headers': headers
             }
-
-        # Delete event from DynamoDB
-        try:
-            table.delete_item(Key={'eventId': event_id})
-            print(f"Successfully deleted event from DynamoDB: {event_id}")
-        except ClientError as e:
-            print(f"Error deleting event from DynamoDB: {str(e)}")
+        if not response:
             return {
-                'statusCode': 500,
-                'body': json.dumps({'error': f'Failed to delete event from DynamoDB: {str(e)}'}),
+                'statusCode': 404,
+                'body': json.dumps({'error': 'Event not found or does not belong to specified timeline'}),
                 'headers': headers
             }
+        print(f"Successfully deleted event from DynamoDB: {event_id}")
+
+        # Only media nothing else uses is deleted
+        try:
+            unreferenced = release_event_media(response)
+        except ClientError as e:
+            # The event is gone either way; ReconcileMediaFunction picks up its media
+            print(f"Error releasing media of {event_id} (ignored): {str(e)}")
+            unreferenced = []
+
+        # One DeleteObjects call; anything it fails to delete is left for
+        # ReconcileMediaFunction and reported back rather than failing the request
+        deleted_files, failed_files = delete_objects(s3_client, bucket_name, unreferenced)
+        print(f"Deleted {len(deleted_files)} S3 objects, {len(failed_files)} failures")
+        # Last, so a failed version bump fails the request only after the media is released
+        record_changes(timelines_table, table, timeline_name, removed=[response])
 
         return {
             'statusCode': 200,
             'body': json.dumps({
                 'success': True,
                 'message': 'Event deleted successfully',
-                'deletedFiles': deleted_files
+                'deletedFiles': deleted_files,
+                'failedFiles': sorted(failed_files)
             }),
             'headers': headers
         }
@@ -0,0 +1,293 @@
+import json
+import os
+import time
+import boto3
+from datetime import datetime
+from botocore.exceptions import ClientError
+from user_cache import invalidate_user
+from session_tokens import authenticate, AuthenticationError
+from media_refs import release_event_media
+from media_io import run_parallel, delete_objects
+from timeline_versions import INDEX_SETTLE_SECONDS
+
+dynamodb = boto3.resource('dynamodb', region_name='eu-west-1')
+s3_client = boto3.client('s3', region_name='eu-west-1')
+lambda_client = boto3.client('lambda', region_name='eu-west-1')
+users_table = dynamodb.Table('Users')
+timelines_table = dynamodb.Table('Timelines')
+
+EVENTS_ID_INDEX = 'TimelineNameIndex'
+EVENTS_PAGE_SIZE = 250
+# A worker owns the job for this long and renews it after every page; a DELETE
+# that finds the lease expired resumes the job in a new worker
+WORKER_LEASE_SECONDS = 120
+# Stop and hand over to a fresh invocation with this much time left
+HANDOVER_MILLIS = 60 * 1000
+DELETE_WORKERS = 8
+
+# Deleting a timeline runs as a background job. DELETE /timelines/{timelineName}
+# marks the Timelines item as deleting, removes the timeline from every user and
+# starts a worker (this function, invoked asynchronously) that deletes its events
+# and their media page by page. Progress and the TimelineNameIndex cursor are
+# saved on the Timelines item after each page, so the job resumes where it left
+# off; the item itself is deleted last. GET on the same path reports progress.
+def progress(item):
+    return {
+        'timelineName': item['timelineName'],
+        'status': item.get('deletionStatus', 'active'),
+        'eventsDeleted': int(item.get('eventsDeleted', 0)),
+        'mediaDeleted': int(item.get('mediaDeleted', 0)),
+        'mediaFailed': int(item.get('mediaFailed', 0)),
+        'deletionStartedAt': item.get('deletionStartedAt')
+    }
+
+def start_worker(timeline_name, function_name):
+    lambda_client.invoke(
+        FunctionName=function_name,
+        InvocationType='Event',
+        Payload=json.dumps({'deleteTimeline': timeline_name})
+    )
+    print(f"Started deletion worker for timeline {timeline_name}")
+
+def acquire_lease(timeline_name):
+    # True when this invocation now owns the job
+    now = int(time.time())
+    try:
+        timelines_table.update_item(
+            Key={'timelineName': timeline_name},
+            UpdateExpression='SET deletionLeaseUntil = :until',
+            ConditionExpression='deletionStatus = :deleting AND (attribute_not_exists(deletionLeaseUntil) OR deletionLeaseUntil < :now)',
+            ExpressionAttributeValues={':until': now + WORKER_LEASE_SECONDS, ':deleting': 'deleting', ':now': now}
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+
+def remove_from_users(timeline_name):
+    # Revoke access first so nobody keeps adding events while the job runs
+    scan_kwargs = {
+        'ProjectionExpression': 'email, timelines',
+        'FilterExpression': 'contains(timelines, :tn)',
+        'ExpressionAttributeValues': {':tn': timeline_name}
+    }
+    while True:
+        response = users_table.scan(**scan_kwargs)
+        for user in response.get('Items', []):
+            timelines = user.get('timelines', [])
+            if timeline_name not in timelines:
+                continue
+            index = timelines.index(timeline_name)
+            try:
+                # Remove by position, but only if the list has not shifted meanwhile
+                users_table.update_item(
+                    Key={'email': user['email']},
+                    UpdateExpression=f'REMOVE timelines[{index}] ADD permissionsVersion :one',
+                    ConditionExpression=f'timelines[{index}] = :tn',
+                    ExpressionAttributeValues={':tn': timeline_name, ':one': 1}
+                )
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                print(f"Timelines of {user['email']} changed meanwhile, will retry")
+                return False
+            invalidate_user(user['email'])
+            print(f"Removed timeline {timeline_name} from user {user['email']}")
+        if 'LastEvaluatedKey' not in response:
+            return True
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def delete_page(events_table, bucket_name, events):
+    # The index is eventually consistent and may still list events deleted a
+    # moment ago, and DeleteEventsFunction may tombstone one at any time. Every
+    # delete returns the item it removed, and media is released only for the
+    # events (not tombstones) that a delete actually removed, so retried and
+    # repeated pages never release media twice. The deletes run concurrently on
+    # the low-level client, which unlike the Table resource is thread-safe.
+    client = events_table.meta.client
+    removed, errors = run_parallel({
+        item['eventId']: (lambda item=item: client.delete_item(
+            TableName=events_table.name,
+            Key={'eventId': item['eventId']},
+            ReturnValues='ALL_OLD'
+        ).get('Attributes'))
+        for item in events
+    }, workers=DELETE_WORKERS)
+    for event_id, error in errors.items():
+        # Left for the next pass
+        print(f"Error deleting event {event_id}: {error}")
+    deleted_events = [item for item in removed.values() if item and not item.get('deleted')]
+
+    unreferenced = []
+    for item in deleted_events:
+        unreferenced.extend(release_event_media(item))
+    deleted_media, failed_media = delete_objects(s3_client, bucket_name, unreferenced)
+    return len(deleted_events), len(deleted_media), len(failed_media)
+
+def run_job(timeline_name, context):
+    if not acquire_lease(timeline_name):
+        print(f"Deletion of {timeline_name} is owned by another worker or not pending")
+        return
+    events_table = dynamodb.Table(os.environ.get('EVENTS_TABLE', 'TimelineEvents'))
+    bucket_name = os.environ.get('MEDIA_BUCKET', 'evidence-timeline-media')
+    item = timelines_table.get_item(Key={'timelineName': timeline_name}, ConsistentRead=True)['Item']
+
+    if not item.get('usersUpdated'):
+        if not remove_from_users(timeline_name):
+            # Lost a race with a concurrent permissions change; the next worker rescans
+            timelines_table.update_item(Key={'timelineName': timeline_name}, UpdateExpression='REMOVE deletionLeaseUntil')
+            start_worker(timeline_name, context.function_name)
+            return
+        timelines_table.update_item(
+            Key={'timelineName': timeline_name},
+            UpdateExpression='SET usersUpdated = :true',
+            ExpressionAttributeValues={':true': True}
+        )
+
+    query_kwargs = {
+        'IndexName': EVENTS_ID_INDEX,
+        'KeyConditionExpression': 'timelineName = :tn',
+        'ExpressionAttributeValues': {':tn': timeline_name},
+        'ProjectionExpression': 'eventId',
+        'Limit': EVENTS_PAGE_SIZE
+    }
+    if item.get('deletionCursor'):
+        query_kwargs['ExclusiveStartKey'] = item['deletionCursor']
+    while True:
+        response = events_table.query(**query_kwargs)
+        events = response.get('Items', [])
+        cursor = response.get('LastEvaluatedKey')
+        events_deleted, media_deleted, media_failed = delete_page(events_table, bucket_name, events) if events else (0, 0, 0)
+        values = {
+            ':now': datetime.utcnow().isoformat(),
+            ':until': int(time.time()) + WORKER_LEASE_SECONDS,
+            ':events': events_deleted,
+            ':media': media_deleted,
+            ':failed': media_failed
+        }
+        if cursor:
+            values[':cursor'] = cursor
+            update_expression = 'SET updatedAt = :now, deletionLeaseUntil = :until, deletionCursor = :cursor'
+        else:
+            update_expression = 'SET updatedAt = :now, deletionLeaseUntil = :until REMOVE deletionCursor'
+        timelines_table.update_item(
+            Key={'timelineName': timeline_name},
+            UpdateExpression=update_expression + ' ADD eventsDeleted :events, mediaDeleted :media, mediaFailed :failed',
+            ExpressionAttributeValues=values
+        )
+        print(f"Deleted {events_deleted} events and {media_deleted} media objects of {timeline_name} ({media_failed} media failed)")
+
+        if cursor:
+            query_kwargs['ExclusiveStartKey'] = cursor
+        elif events or 'ExclusiveStartKey' in query_kwargs:
+            # End of a pass: check again from the start for failed deletes and
+            # events added meanwhile; an empty pass means the timeline is empty.
+            # Until the index catches up it still lists the events just deleted,
+            # so give it time rather than querying them again straight away.
+            query_kwargs.pop('ExclusiveStartKey', None)
+            time.sleep(INDEX_SETTLE_SECONDS)
+        else:
+            break
+        if context.get_remaining_time_in_millis() < HANDOVER_MILLIS:
+            timelines_table.update_item(Key={'timelineName': timeline_name}, UpdateExpression='REMOVE deletionLeaseUntil')
+            start_worker(timeline_name, context.function_name)
+            return
+
+    timelines_table.delete_item(Key={'timelineName': timeline_name})
+    print(f"Timeline {timeline_name} deleted")
+
+def lambda_handler(event, context):
+    if 'deleteTimeline' in event:
+        run_job(event['deleteTimeline'], context)
+        return
+
+    headers = {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET,DELETE,OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token,X-Auth-Email'
+    }
+    print("Received event:", json.dumps(event))
+    try:
+        http_method = event.get('httpMethod', '')
+        if http_method == 'OPTIONS':
+            return {
+                'statusCode': 200,
+                'body': json.dumps({'message': 'CORS preflight'}),
+                'headers': headers
+            }
+        timeline_name = ((event.get('pathParameters') or {}).get('timelineName') or '').strip()
+        try:
+            # Deletion is irreversible, so check the current role and timelines
+            user, auth_headers = authenticate(event, users_table, refresh=True)
+        except AuthenticationError as e:
+            return {
+                'statusCode': e.status_code,
+                'body': json.dumps({'error': str(e)}),
+                'headers': headers
+            }
+        headers.update(auth_headers)
+        auth_email = user['email']
+        if not timeline_name:
+            return {
+                'statusCode': 400,
+                'body': json.dumps({'error': 'Missing timelineName in path'}),
+                'headers': headers
+            }
+        user_role = user.get('role', 'viewer')
+        # The timeline is already gone from timeline admins' lists once the job has
+        # started, so they can only start it; super admins can follow it to the end
+        if user_role != 'super_admin' and (user_role != 'timeline_admin' or timeline_name not in user.get('timelines', [])):
+            return {
+                'statusCode': 403,
+                'body': json.dumps({'error': 'Unauthorized: You cannot delete this timeline'}),
+                'headers': headers
+            }
+
+        item = timelines_table.get_item(Key={'timelineName': timeline_name}, ConsistentRead=True).get('Item')
+        if not item:
+            return {
+                'statusCode': 404,
+                'body': json.dumps({'error': 'Timeline not found'}),
+                'headers': headers
+            }
+
+        if http_method == 'GET':
+            return {
+                'statusCode': 200,
+                'body': json.dumps(progress(item)),
+                'headers': headers
+            }
+
+        if http_method == 'DELETE':
+            if item.get('deletionStatus') != 'deleting':
+                item.update(deletionStatus='deleting', deletionStartedAt=datetime.utcnow().isoformat())
+                timelines_table.update_item(
+                    Key={'timelineName': timeline_name},
+                    UpdateExpression='SET deletionStatus = :deleting, deletionStartedAt = :started',
+                    ExpressionAttributeValues={':deleting': 'deleting', ':started': item['deletionStartedAt']}
+                )
+                print(f"User {auth_email} started deletion of timeline {timeline_name}")
+            # Starts the job, or resumes it when its last worker stopped renewing the lease
+            if int(item.get('deletionLeaseUntil', 0)) < time.time():
+                start_worker(timeline_name, context.function_name)
+            return {
+                'statusCode': 202,
+                'body': json.dumps(progress(item)),
+                'headers': headers
+            }
+
+        return {
+            'statusCode': 405,
+            'body': json.dumps({'error': 'Method not allowed'}),
+            'headers': headers
+        }
+
+    except Exception as e:
+        print("Unexpected error:", str(e))
+        return {
+            'statusCode': 500,
+            'body': json.dumps({'error': 'Internal server error'}),
+            'headers': headers
+        }
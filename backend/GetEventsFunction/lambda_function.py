@@ -1,52 +1,177 @@
 import json
 import os
+import time
+from decimal import Decimal
+from datetime import datetime, timedelta, timezone
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from session_tokens import authenticate, AuthenticationError
+from cursors import encode_token, decode_token, encode_cursor, decode_cursor, query_scope
+from event_sync import TOMBSTONE_TTL_DAYS
+from timeline_versions import get_version, make_etag, etag_matches, etag_headers, not_modified
+from responses import compress_response
+from ulids import ULID_LENGTH, ulid_lower_bound
 
 dynamodb = boto3.resource('dynamodb', region_name='eu-west-1')
 users_table = dynamodb.Table('Users')
+timelines_table = dynamodb.Table('Timelines')
+# Presigning is local (no request to S3), and reusing one client reuses its signer
+s3_client = boto3.client('s3', region_name='eu-west-1', config=Config(signature_version='s3v4', s3={'addressing_style': 'virtual'}))
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# GSI with timelineName as partition key and the normalized ISO date as sort key
+EVENTS_DATE_INDEX = os.environ.get("EVENTS_DATE_INDEX", "TimelineDateIndex")
+# TimelineNameIndex is keyed on timelineName + eventId; event IDs are ULIDs,
+# which sort by creation time (see ulids)
+EVENTS_ID_INDEX = "TimelineNameIndex"
+# GSI keyed on timelineName + updatedAt (projecting all attributes) for delta sync
+EVENTS_UPDATED_INDEX = os.environ.get("EVENTS_UPDATED_INDEX", "TimelineUpdatedIndex")
+# A sync token starts this far before the request, so writes that were in
+# flight (or not yet in the index) are sent again rather than missed
+SYNC_OVERLAP_SECONDS = 5
+MEDIA_BASE_URL = os.environ.get("MEDIA_BASE_URL", "https://evidence-timeline-media.s3.eu-west-1.amazonaws.com")
+MEDIA_BUCKET = os.environ.get("MEDIA_BUCKET", "evidence-timeline-media")
+MEDIA_URL_EXPIRY_SECONDS = int(os.environ.get("MEDIA_URL_EXPIRY_SECONDS", "3600"))
+# Signed URLs are reused for a quarter of their lifetime, so a URL handed out
+# is always valid for at least three quarters of MEDIA_URL_EXPIRY_SECONDS
+MEDIA_URL_CACHE_SECONDS = max(1, MEDIA_URL_EXPIRY_SECONDS // 4)
+# fields= takes a view name or a comma separated list of these attributes
+EVENT_FIELDS = ["eventId", "timelineName", "date", "description", "originalFileKey", "croppedFileKey", "mediaVariants", "updatedAt"]
+FIELD_VIEWS = {
+    # Enough for overviews and date pickers
+    "summary": ["eventId", "date", "croppedFileKey"],
+    "full": None
+}
+# Accepted bound granularities, told apart by length
+DATE_BOUND_FORMATS = {4: "%Y", 7: "%Y-%m", 10: "%Y-%m-%d", 16: "%Y-%m-%dT%H:%M", 19: "%Y-%m-%dT%H:%M:%S"}
+
+def new_sync_token():
+    since = (datetime.utcnow() - timedelta(seconds=SYNC_OVERLAP_SECONDS)).isoformat(timespec="milliseconds")
+    return encode_token({"since": since})
+
+def decode_sync_token(token):
+    # Returns the updatedAt to sync from; tokens older than the tombstones'
+    # lifetime could miss deletes and are rejected
+    since = decode_token(token).get("since")
+    if not isinstance(since, str):
+        raise ValueError("Sync token does not contain a timestamp")
+    if datetime.fromisoformat(since) < datetime.utcnow() - timedelta(days=TOMBSTONE_TTL_DAYS):
+        return None
+    return since
+
+def event_id_lower_bound(created_since):
+    # Smallest ULID created at or after the given ISO timestamp
+    value = created_since.strip()
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return ulid_lower_bound(parsed.timestamp() * 1000)
+
+def decimal_default(value):
+    # DynamoDB numbers (e.g. mediaVariants dimensions) come back as Decimal
+    if isinstance(value, Decimal):
+        return int(value) if value % 1 == 0 else float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def add_media_urls(event_item):
+    # Media keys are immutable, so these URLs can be cached forever and an edit
+    # shows up as a different URL rather than needing a cache-busting query string
+    for kind in ["original", "cropped"]:
+        if event_item.get(f"{kind}FileKey"):
+            event_item[f"{kind}Url"] = f"{MEDIA_BASE_URL}/{event_item[f'{kind}FileKey']}"
+
+def add_srcset(event_item):
+    # srcset strings per format from the variants written by ProcessMediaFunction
+    variants = sorted(event_item.get("mediaVariants", []), key=lambda variant: variant["width"])
+    if not variants:
+        return
+    event_item["srcset"] = {
+        extension: ", ".join(f"{MEDIA_BASE_URL}/{variant[extension]} {int(variant['width'])}w" for variant in variants if extension in variant)
+        for extension in ["webp", "jpeg"]
+    }
+
+# Per-container cache of presigned GET URLs for the current expiry bucket
+_signed_urls = {"bucket": None, "urls": {}}
+
+def signed_media_manifest(events):
+    # One presigned GET per media key on the page (variants included, since the
+    # srcset points at them), for when the bucket is not publicly readable
+    expiry_bucket = int(time.time()) // MEDIA_URL_CACHE_SECONDS
+    if _signed_urls["bucket"] != expiry_bucket:
+        _signed_urls["bucket"] = expiry_bucket
+        _signed_urls["urls"] = {}
+    urls = _signed_urls["urls"]
+    manifest = {}
+    for event_item in events:
+        keys = [event_item.get("originalFileKey"), event_item.get("croppedFileKey")]
+        for variant in event_item.get("mediaVariants", []):
+            keys.extend([variant.get("webp"), variant.get("jpeg")])
+        for key in keys:
+            if not key or key in manifest:
+                continue
+            if key not in urls:
+                urls[key] = s3_client.generate_presigned_url(
+                    "get_object",
+                    Params={"Bucket": MEDIA_BUCKET, "Key": key},
+                    ExpiresIn=MEDIA_URL_EXPIRY_SECONDS
+                )
+            manifest[key] = urls[key]
+    # Every URL in the bucket was signed no earlier than the bucket's start
+    return manifest, expiry_bucket * MEDIA_URL_CACHE_SECONDS + MEDIA_URL_EXPIRY_SECONDS
+
+def projected_fields(value):
+    # Attributes to read, or None for all of them
+    value = (value or "full").strip()
+    if value in FIELD_VIEWS:
+        return FIELD_VIEWS[value]
+    fields = [field.strip() for field in value.split(",") if field.strip()]
+    unknown = [field for field in fields if field not in EVENT_FIELDS]
+    if not fields or unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown) or value}")
+    # Items are told apart by eventId, so it is always included
+    return list(dict.fromkeys(["eventId"] + fields))
+
+def date_bound(value, upper):
+    # Dates are stored as YYYY-MM-DDTHH:MM[:SS] so bounds can be any prefix of that.
+    # An upper bound of "2024-03" has to include "2024-03-31T23:59:59", hence the
+    # trailing "~", which sorts after every character used in the stored dates.
+    value = value.strip().rstrip('Z')
+    date_format = DATE_BOUND_FORMATS.get(len(value))
+    try:
+        # strptime also rejects impossible dates such as 2024-13 or 2024-02-31;
+        # the round trip rejects unpadded fields it would otherwise accept
+        valid = bool(date_format) and datetime.strptime(value, date_format).strftime(date_format) == value
+    except ValueError:
+        valid = False
+    if not valid:
+        raise ValueError(f"Invalid date bound: {value}")
+    return value + '~' if upper else value
 
 def lambda_handler(event, context):
     headers = {
         "Content-Type": "application/json",
         "Access-Control-Allow-Origin": "*",
         "Access-Control-Allow-Methods": "GET,POST,OPTIONS",
-        "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token,X-Auth-Email"
+        "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token,X-Auth-Email,If-None-Match"
     }
     
     try:
-        # Validate X-Auth-Email header (case-insensitive)
-        auth_email = None
-        if event.get('headers') and isinstance(event['headers'], dict):
-            auth_email = event['headers'].get('X-Auth-Email', event['headers'].get('x-auth-email', '')).strip()
-        if not auth_email:
-            print("Missing X-Auth-Email header")
-            return {
-                "statusCode": 400,
-                "headers": headers,
-                "body": json.dumps({"error": "Missing X-Auth-Email header"})
-            }
-
-        # Fetch user details
         try:
-            user_response = users_table.get_item(Key={'email': auth_email})
-            user = user_response.get('Item')
-            if not user:
-                print("User not found for email:", auth_email)
-                return {
-                    "statusCode": 401,
-                    "headers": headers,
-                    "body": json.dumps({"error": "User not found"})
-                }
-            user_role = user.get('role', 'viewer')
-            user_timelines = user.get('timelines', [])
-        except ClientError as e:
-            print(f"Error fetching user: {str(e)}")
+            user, auth_headers = authenticate(event, users_table)
+        except AuthenticationError as e:
             return {
-                "statusCode": 500,
+                "statusCode": e.status_code,
                 "headers": headers,
-                "body": json.dumps({"error": f"Failed to fetch user: {str(e)}"})
+                "body": json.dumps({"error": str(e)})
             }
+        headers.update(auth_headers)
+        auth_email = user["email"]
+        user_role = user.get('role', 'viewer')
+        user_timelines = user.get('timelines', [])
 
         table_name = os.environ.get("EVENTS_TABLE")
         if not table_name:
@@ -82,19 +207,194 @@ def lambda_handler(event, context):
                     "body": json.dumps({"error": "Unauthorized: You do not have access to this timeline"})
                 }
 
+            # Pagination parameters
             try:
-                response = table.query(
-                    IndexName="TimelineNameIndex",
-                    KeyConditionExpression="timelineName = :tn",
-                    ExpressionAttributeValues={":tn": timeline_name}
-                )
-                events = response.get("Items", [])
-                print(f"Fetched {len(events)} events for timeline: {timeline_name}")
+                limit = int(query_parameters.get("limit") or DEFAULT_PAGE_SIZE)
+            except ValueError:
+                limit = 0
+            if limit < 1 or limit > MAX_PAGE_SIZE:
+                print("Invalid limit:", query_parameters.get("limit"))
                 return {
-                    "statusCode": 200,
+                    "statusCode": 400,
+                    "headers": headers,
+                    "body": json.dumps({"error": f"limit must be an integer between 1 and {MAX_PAGE_SIZE}"})
+                }
+
+            # Date range and ordering
+            order = (query_parameters.get("order") or "asc").lower()
+            if order not in ["asc", "desc"]:
+                return {
+                    "statusCode": 400,
+                    "headers": headers,
+                    "body": json.dumps({"error": "order must be asc or desc"})
+                }
+            try:
+                date_from = date_bound(query_parameters["from"], upper=False) if query_parameters.get("from") else None
+                date_to = date_bound(query_parameters["to"], upper=True) if query_parameters.get("to") else None
+            except ValueError as e:
+                print(str(e))
+                return {
+                    "statusCode": 400,
+                    "headers": headers,
+                    "body": json.dumps({"error": "from/to must be ISO dates (YYYY, YYYY-MM, YYYY-MM-DD or YYYY-MM-DDTHH:MM[:SS])"})
+                }
+
+            try:
+                fields = projected_fields(query_parameters.get("fields"))
+            except ValueError as e:
+                print(str(e))
+                return {
+                    "statusCode": 400,
+                    "headers": headers,
+                    "body": json.dumps({"error": f"fields must be one of {', '.join(FIELD_VIEWS)} or a comma separated list of {', '.join(EVENT_FIELDS)}"})
+                }
+
+            created_since = query_parameters.get("createdSince")
+            sync_token = query_parameters.get("since")
+            if sync_token and (created_since or date_from or date_to or query_parameters.get("order")):
+                return {
+                    "statusCode": 400,
+                    "headers": headers,
+                    "body": json.dumps({"error": "since cannot be combined with from/to, createdSince or order"})
+                }
+            if created_since and (date_from or date_to):
+                return {
+                    "statusCode": 400,
+                    "headers": headers,
+                    "body": json.dumps({"error": "createdSince cannot be combined with from/to"})
+                }
+            if date_from and date_to and date_from > date_to:
+                return {
+                    "statusCode": 400,
                     "headers": headers,
-                    "body": json.dumps({"events": events})
+                    "body": json.dumps({"error": "from must not be after to"})
                 }
+
+            key_condition = "timelineName = :tn"
+            expression_values = {":tn": timeline_name}
+            if date_from and date_to:
+                key_condition += " AND #date BETWEEN :from AND :to"
+                expression_values[":from"] = date_from
+                expression_values[":to"] = date_to
+            elif date_from:
+                key_condition += " AND #date >= :from"
+                expression_values[":from"] = date_from
+            elif date_to:
+                key_condition += " AND #date <= :to"
+                expression_values[":to"] = date_to
+
+            query_kwargs = {
+                "IndexName": EVENTS_DATE_INDEX,
+                "KeyConditionExpression": key_condition,
+                "ExpressionAttributeValues": expression_values,
+                "ScanIndexForward": order == "asc",
+                "Limit": limit
+            }
+            if date_from or date_to:
+                # "date" is a DynamoDB reserved word
+                query_kwargs["ExpressionAttributeNames"] = {"#date": "date"}
+            if created_since:
+                try:
+                    since_id = event_id_lower_bound(created_since)
+                except ValueError:
+                    return {
+                        "statusCode": 400,
+                        "headers": headers,
+                        "body": json.dumps({"error": "createdSince must be an ISO 8601 timestamp"})
+                    }
+                # Results come back in creation order
+                query_kwargs["IndexName"] = EVENTS_ID_INDEX
+                query_kwargs["KeyConditionExpression"] = "timelineName = :tn AND eventId >= :since"
+                # Tombstones of deleted events are in this index too, and legacy
+                # UUID IDs sort among the ULIDs without saying when they were created
+                query_kwargs["FilterExpression"] = "attribute_not_exists(deleted) AND size(eventId) = :ulid_len"
+                expression_values[":since"] = since_id
+                expression_values[":ulid_len"] = ULID_LENGTH
+            if sync_token:
+                try:
+                    sync_since = decode_sync_token(sync_token)
+                except (ValueError, TypeError) as e:
+                    print("Invalid sync token:", str(e))
+                    return {
+                        "statusCode": 400,
+                        "headers": headers,
+                        "body": json.dumps({"error": "Invalid sync token"})
+                    }
+                if not sync_since:
+                    return {
+                        "statusCode": 410,
+                        "headers": headers,
+                        "body": json.dumps({"error": "Sync token expired, reload the timeline"})
+                    }
+                # Everything written after the token, tombstones included, oldest first
+                query_kwargs["IndexName"] = EVENTS_UPDATED_INDEX
+                query_kwargs["KeyConditionExpression"] = "timelineName = :tn AND updatedAt > :since"
+                query_kwargs["ScanIndexForward"] = True
+                expression_values[":since"] = sync_since
+            if fields:
+                # Tombstones are recognized by their deleted flag
+                if sync_token:
+                    fields = fields + ["deleted"]
+                attribute_names = query_kwargs.setdefault("ExpressionAttributeNames", {})
+                for index, field in enumerate(fields):
+                    attribute_names[f"#f{index}"] = field
+                query_kwargs["ProjectionExpression"] = ", ".join(f"#f{index}" for index in range(len(fields)))
+            # Cursors only resume the query they came from
+            scope = query_scope(*(query_kwargs.get(name) for name in ["IndexName", "KeyConditionExpression", "ExpressionAttributeValues", "ScanIndexForward"]))
+            cursor = query_parameters.get("cursor")
+            if cursor:
+                try:
+                    start_key = decode_cursor(cursor, scope)
+                except (ValueError, TypeError) as e:
+                    print("Invalid cursor:", str(e))
+                    start_key = None
+                if not start_key or start_key.get("timelineName") != timeline_name:
+                    return {
+                        "statusCode": 400,
+                        "headers": headers,
+                        "body": json.dumps({"error": "Invalid cursor"})
+                    }
+                query_kwargs["ExclusiveStartKey"] = start_key
+
+            # The same query against the same timeline version gives the same page;
+            # signed media URLs also change with their expiry bucket
+            version = get_version(timelines_table, timeline_name)
+            etag = None
+            if version is not None:
+                signed_bucket = int(time.time()) // MEDIA_URL_CACHE_SECONDS if query_parameters.get("media") == "signed" else None
+                etag = make_etag(timeline_name, version, query_parameters, signed_bucket, weak=True)
+                if etag_matches(event.get("headers"), etag):
+                    print(f"Timeline {timeline_name} unchanged at version {version}")
+                    return not_modified(headers, etag)
+
+            # Taken before reading, so anything written during the read is in the
+            # next sync; clients keep the token of the first page
+            next_sync_token = None if cursor else new_sync_token()
+            try:
+                response = table.query(**query_kwargs)
+                events = response.get("Items", [])
+                deleted_ids = [event_item["eventId"] for event_item in events if event_item.get("deleted")]
+                events = [event_item for event_item in events if not event_item.get("deleted")]
+                for event_item in events:
+                    add_media_urls(event_item)
+                    add_srcset(event_item)
+                last_evaluated_key = response.get("LastEvaluatedKey")
+                next_cursor = encode_cursor(last_evaluated_key, scope) if last_evaluated_key else None
+                print(f"Fetched {len(events)} events for timeline: {timeline_name} (more: {next_cursor is not None})")
+                result = {"events": events, "nextCursor": next_cursor}
+                if sync_token:
+                    result["deleted"] = deleted_ids
+                if next_sync_token:
+                    result["syncToken"] = next_sync_token
+                if query_parameters.get("media") == "signed":
+                    result["media"], result["mediaExpiresAt"] = signed_media_manifest(events)
+                if etag:
+                    headers.update(etag_headers(headers, etag))
+                return compress_response({
+                    "statusCode": 200,
+                    "headers": headers,
+                    "body": json.dumps(result, default=decimal_default)
+                }, event.get("headers"))
             except ClientError as e:
                 error_code = e.response["Error"]["Code"]
                 error_message = e.response["Error"]["Message"]
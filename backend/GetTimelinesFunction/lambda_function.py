@@ -1,43 +1,94 @@
 import json
 import boto3
 import os
+from session_tokens import authenticate, AuthenticationError
+from timeline_versions import make_etag, etag_matches, etag_headers, not_modified
+from responses import compress_response
+from timeline_summary import summary_from_item
+from dynamo_batch import batch_get
+from cursors import encode_cursor, decode_cursor, query_scope
 
 dynamodb = boto3.resource('dynamodb', region_name='eu-west-1')
 users_table = dynamodb.Table('Users')
 timelines_table = dynamodb.Table('Timelines')
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_SCAN_SEGMENTS = 16
+
+def scan_scope(scan_kwargs):
+    # A cursor only continues the scan segment it came from
+    return query_scope('timelines', scan_kwargs.get('Segment'), scan_kwargs.get('TotalSegments'))
+
+def parse_scan_parameters(query_parameters):
+    # Returns scan kwargs for one page; segment/totalSegments let clients list in parallel
+    limit = int(query_parameters.get('limit') or DEFAULT_PAGE_SIZE)
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise ValueError(f'limit must be between 1 and {MAX_PAGE_SIZE}')
+    scan_kwargs = {
+        'ProjectionExpression': 'timelineName',
+        # Timelines being deleted by DeleteTimelineFunction are already hidden
+        'FilterExpression': 'attribute_not_exists(deletionStatus)',
+        'Limit': limit
+    }
+    total_segments = query_parameters.get('totalSegments')
+    if total_segments is not None:
+        total_segments = int(total_segments)
+        segment = int(query_parameters.get('segment', 0))
+        if total_segments < 1 or total_segments > MAX_SCAN_SEGMENTS or not 0 <= segment < total_segments:
+            raise ValueError(f'segment must be in [0, totalSegments) and totalSegments at most {MAX_SCAN_SEGMENTS}')
+        scan_kwargs['Segment'] = segment
+        scan_kwargs['TotalSegments'] = total_segments
+    cursor = query_parameters.get('cursor')
+    if cursor:
+        start_key = decode_cursor(cursor, scan_scope(scan_kwargs))
+        if not start_key.get('timelineName'):
+            raise ValueError("Cursor does not contain a start key")
+        scan_kwargs['ExclusiveStartKey'] = start_key
+    return scan_kwargs
+
+def summaries_for(names):
+    # One key lookup per timeline; timelines without a Timelines item have no summary
+    items, _ = batch_get(timelines_table, [{'timelineName': name} for name in names])
+    found = {item['timelineName']: summary_from_item(item) for item in items}
+    return {name: found.get(name) for name in names}
+
+def listing_response(result, headers, request_headers):
+    # Listings have no version of their own; the ETag is a digest of the listing,
+    # so an unchanged one costs a 304 instead of the body. It is weak because the
+    # body may go out compressed or not.
+    etag = make_etag(result, weak=True)
+    if etag_matches(request_headers, etag):
+        return not_modified(headers, etag)
+    return compress_response({
+        'statusCode': 200,
+        'body': json.dumps(result),
+        'headers': dict(headers, **etag_headers(headers, etag))
+    }, request_headers)
+
 def lambda_handler(event, context):
     headers = {
         'Content-Type': 'application/json',
         'Access-Control-Allow-Origin': '*',
         'Access-Control-Allow-Methods': 'GET,OPTIONS',
-        'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token,X-Auth-Email'
+        'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token,X-Auth-Email,Cache-Control,If-None-Match'
     }
     print("Received event:", json.dumps(event))
     print("Headers received:", json.dumps(event.get('headers', {})))
     try:
-        auth_email = None
-        if event.get('headers') and isinstance(event['headers'], dict):
-            # Check for both cases
-            auth_email = event['headers'].get('X-Auth-Email', event['headers'].get('x-auth-email', '')).strip()
-            print("X-Auth-Email:", auth_email)
-        if not auth_email:
+        # "Cache-Control: no-cache" skips both the session token and the container
+        # cache, e.g. right after the caller created a timeline
+        request_headers = event.get('headers') if isinstance(event.get('headers'), dict) else {}
+        refresh = 'no-cache' in request_headers.get('Cache-Control', request_headers.get('cache-control', ''))
+        try:
+            user, auth_headers = authenticate(event, users_table, refresh=refresh)
+            headers.update(auth_headers)
+        except AuthenticationError as e:
             return {
-                'statusCode': 400,
-                'body': json.dumps({'error': 'Missing X-Auth-Email header'}),
+                'statusCode': e.status_code,
+                'body': json.dumps({'error': str(e)}),
                 'headers': headers
             }
-        
-        # Verify user exists in Users table
-        try:
-            response = users_table.get_item(Key={'email': auth_email})
-            user = response.get('Item')
-            if not user:
-                return {
-                    'statusCode': 401,
-                    'body': json.dumps({'error': 'User not found'}),
-                    'headers': headers
-                }
         except Exception as e:
             print("Error fetching user:", str(e))
             return {
@@ -46,25 +97,40 @@ def lambda_handler(event, context):
                 'headers': headers
             }
         
-        # Get timelines
+        # Get timelines; ?summary=true adds each timeline's summary (see timeline_summary)
+        user_role = user.get('role', 'viewer')
+        with_summary = ((event.get('queryStringParameters') or {}).get('summary') or '').lower() == 'true'
+        if user_role != 'super_admin':
+            # timeline_admin and viewer only ever see their own list, no scan needed
+            result = {'timelines': user.get('timelines', []), 'nextCursor': None}
+            if with_summary:
+                result['summaries'] = summaries_for(result['timelines'])
+            return listing_response(result, headers, request_headers)
+
         try:
-            timelines_response = timelines_table.scan()
-            all_timelines = [item['timelineName'] for item in timelines_response.get('Items', [])]
-            user_role = user.get('role', 'viewer')
-            user_timelines = user.get('timelines', [])
-            
-            if user_role == 'super_admin':
-                allowed_timelines = all_timelines
-            elif user_role == 'timeline_admin':
-                allowed_timelines = user_timelines
-            else:  # viewer
-                allowed_timelines = user_timelines
-            
+            scan_kwargs = parse_scan_parameters(event.get('queryStringParameters') or {})
+            if with_summary:
+                # The month counters have one attribute each, so read whole items
+                del scan_kwargs['ProjectionExpression']
+        except (ValueError, TypeError) as e:
+            print("Invalid listing parameters:", str(e))
             return {
-                'statusCode': 200,
-                'body': json.dumps({'timelines': allowed_timelines}),
+                'statusCode': 400,
+                'body': json.dumps({'error': f'Invalid listing parameters: {str(e)}'}),
                 'headers': headers
             }
+
+        try:
+            timelines_response = timelines_table.scan(**scan_kwargs)
+            items = timelines_response.get('Items', [])
+            last_evaluated_key = timelines_response.get('LastEvaluatedKey')
+            result = {
+                'timelines': [item['timelineName'] for item in items],
+                'nextCursor': encode_cursor(last_evaluated_key, scan_scope(scan_kwargs)) if last_evaluated_key else None
+            }
+            if with_summary:
+                result['summaries'] = {item['timelineName']: summary_from_item(item) for item in items}
+            return listing_response(result, headers, request_headers)
         except Exception as e:
             print("Error fetching timelines:", str(e))
             return {
@@ -4,6 +4,8 @@ import bcrypt
 import requests
 from botocore.exceptions import ClientError
 from datetime import datetime
+from session_tokens import issue_token
+from responses import request_body
 
 dynamodb = boto3.resource('dynamodb', region_name='eu-west-1')
 users_table = dynamodb.Table('Users')
@@ -11,7 +13,7 @@ login_logs_table = dynamodb.Table('LoginLogs')
 
 def lambda_handler(event, context):
     try:
-        body = json.loads(event.get('body', '{}'))
+        body = json.loads(request_body(event))
         email = body.get('email', '').strip()
         password = body.get('password', '').strip()
         headers = event.get('headers', {})
@@ -74,6 +76,13 @@ def lambda_handler(event, context):
                 pass
 
             is_admin = user_response['role'] in ['super_admin', 'timeline_admin']
+            # Signed token lets later requests skip the Users read
+            token, token_expires_at = issue_token({
+                'email': email,
+                'role': user_response['role'],
+                'timelines': user_response.get('timelines', []),
+                'permissionsVersion': user_response.get('permissionsVersion', 0)
+            })
             return {
                 'statusCode': 200,
                 'body': json.dumps({
@@ -82,7 +91,9 @@ def lambda_handler(event, context):
                     'role': user_response['role'],
                     'timelines': user_response.get('timelines', []),
                     'email': email,
-                    'username': user_response.get('username', '')
+                    'username': user_response.get('username', ''),
+                    'token': token,
+                    'tokenExpiresAt': token_expires_at
                 }),
                 'headers': response_headers
             }
@@ -1,33 +1,35 @@
 import json
+import os
 import boto3
 import bcrypt
 from botocore.exceptions import ClientError
 from datetime import datetime
+from user_cache import invalidate_user
+from session_tokens import authenticate, AuthenticationError
+from responses import request_body
 
 dynamodb = boto3.resource('dynamodb', region_name='eu-west-1')
 users_table = dynamodb.Table('Users')
+usernames_table = dynamodb.Table(os.environ.get('USERNAMES_TABLE', 'Usernames'))
 
 def lambda_handler(event, context):
     try:
         http_method = event['httpMethod']
-        headers = event.get('headers', {})
-        auth_email = headers.get('X-Auth-Email', '').strip()
-
-        if not auth_email:
-            return {
-                'statusCode': 401,
-                'body': json.dumps({'error': 'Missing authentication email'}),
-                'headers': {'Access-Control-Allow-Origin': '*'}
-            }
-        
         try:
-            user_response = users_table.get_item(Key={'email': auth_email})
-            if 'Item' not in user_response or user_response['Item']['role'] != 'super_admin':
+            # Role changes and user deletion act on the current role, not a token's copy
+            user, _ = authenticate(event, users_table, refresh=True)
+            if user.get('role') != 'super_admin':
                 return {
                     'statusCode': 403,
                     'body': json.dumps({'error': 'Unauthorized: Super admin access required'}),
                     'headers': {'Access-Control-Allow-Origin': '*'}
                 }
+        except AuthenticationError as e:
+            return {
+                'statusCode': e.status_code,
+                'body': json.dumps({'error': str(e)}),
+                'headers': {'Access-Control-Allow-Origin': '*'}
+            }
         except ClientError as e:
             return {
                 'statusCode': 500,
@@ -57,7 +59,7 @@ def lambda_handler(event, context):
 
 def create_user(event):
     try:
-        body = json.loads(event['body'])
+        body = json.loads(request_body(event))
         email = body.get('email')
         password = body.get('password')
         role = body.get('role')
@@ -76,26 +78,30 @@ def create_user(event):
                 'headers': {'Access-Control-Allow-Origin': '*'}
             }
 
-        existing_user = users_table.get_item(Key={'email': email}).get('Item')
-        if existing_user:
+        hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=10)).decode('utf-8')
+        now = datetime.utcnow().isoformat()
+
+        try:
+            users_table.put_item(
+                Item={
+                    'email': email,
+                    'password': hashed_password,
+                    'role': role,
+                    'timelines': timelines,
+                    'createdAt': now,
+                    'updatedAt': now
+                },
+                ConditionExpression='attribute_not_exists(email)'
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
             return {
                 'statusCode': 409,
                 'body': json.dumps({'error': 'User already exists'}),
                 'headers': {'Access-Control-Allow-Origin': '*'}
             }
 
-        hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=10)).decode('utf-8')
-        now = datetime.utcnow().isoformat()
-
-        users_table.put_item(Item={
-            'email': email,
-            'password': hashed_password,
-            'role': role,
-            'timelines': timelines,
-            'createdAt': now,
-            'updatedAt': now
-        })
-
         return {
             'statusCode': 201,
             'body': json.dumps({'message': f'User {email} created successfully'}),
@@ -113,7 +119,7 @@ def update_user(event):
     try:
         path_params = event.get('pathParameters', {})
         email = path_params.get('email')
-        body = json.loads(event['body'])
+        body = json.loads(request_body(event))
         password = body.get('password')
         role = body.get('role')
         timelines = body.get('timelines')
@@ -151,11 +157,16 @@ def update_user(event):
             update_expression += ', timelines = :timelines'
             expression_values[':timelines'] = timelines
 
+        # Bump the version so stale cached permissions can be detected
+        update_expression += ' ADD permissionsVersion :one'
+        expression_values[':one'] = 1
+
         users_table.update_item(
             Key={'email': email},
             UpdateExpression=update_expression,
             ExpressionAttributeValues=expression_values
         )
+        invalidate_user(email)
 
         return {
             'statusCode': 200,
@@ -191,6 +202,18 @@ def delete_user(event):
             }
 
         users_table.delete_item(Key={'email': email})
+        if existing_user.get('username'):
+            # Free the username for a new signup, unless another user holds it
+            try:
+                usernames_table.delete_item(
+                    Key={'username': existing_user['username']},
+                    ConditionExpression='email = :email',
+                    ExpressionAttributeValues={':email': email}
+                )
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+        invalidate_user(email)
 
         return {
             'statusCode': 200,
@@ -0,0 +1,76 @@
+import io
+import os
+import boto3
+from botocore.exceptions import ClientError
+from PIL import Image, ImageOps
+from event_sync import updated_at
+from timeline_versions import bump_version
+
+s3_client = boto3.client('s3', region_name='eu-west-1')
+dynamodb = boto3.resource('dynamodb', region_name='eu-west-1')
+timelines_table = dynamodb.Table('Timelines')
+
+VARIANT_WIDTHS = [320, 640, 1280]
+VARIANT_FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpeg': ('JPEG', 'image/jpeg')
+}
+VARIANT_QUALITY = int(os.environ.get('VARIANT_QUALITY', '80'))
+# Variant keys derive from the (immutable) cropped key, so they never change either
+MEDIA_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+def variant_key(cropped_file_key, width, extension):
+    # events/cropped/<name>.png -> events/variants/<name>/w640.webp
+    name = cropped_file_key.rsplit('/', 1)[-1].rsplit('.', 1)[0]
+    return f"events/variants/{name}/w{width}.{extension}"
+
+# Invoked asynchronously by AddUpdateEventFunction once an event references a new
+# cropped image. Writes resized WebP/JPEG copies and records them on the event
+# item as mediaVariants so GET /events can return a srcset.
+def lambda_handler(event, context):
+    bucket_name = os.environ.get('MEDIA_BUCKET', 'evidence-timeline-media')
+    table = dynamodb.Table(os.environ.get('EVENTS_TABLE', 'TimelineEvents'))
+    event_id = event['eventId']
+    cropped_file_key = event['croppedFileKey']
+
+    source = s3_client.get_object(Bucket=bucket_name, Key=cropped_file_key)['Body'].read()
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(source)))
+    if image.mode not in ['RGB', 'L']:
+        # JPEG has no alpha channel; flatten onto white
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.convert('RGBA').split()[-1])
+        image = background
+
+    # Never upscale: widths above the source collapse to the source width
+    widths = sorted({min(width, image.width) for width in VARIANT_WIDTHS})
+    variants = []
+    for width in widths:
+        height = max(1, round(image.height * width / image.width))
+        resized = image if width == image.width else image.resize((width, height), Image.LANCZOS)
+        variant = {'width': width, 'height': height}
+        for extension, (pil_format, content_type) in VARIANT_FORMATS.items():
+            buffer = io.BytesIO()
+            resized.save(buffer, format=pil_format, quality=VARIANT_QUALITY)
+            key = variant_key(cropped_file_key, width, extension)
+            s3_client.put_object(Bucket=bucket_name, Key=key, Body=buffer.getvalue(), ContentType=content_type, CacheControl=MEDIA_CACHE_CONTROL)
+            variant[extension] = key
+        variants.append(variant)
+        print(f"Wrote {width}x{height} variants for {cropped_file_key}")
+
+    try:
+        # Only record them if the event still points at the image they were made from
+        # updatedAt and the timeline version change too, so clients pick up the srcset
+        timeline_name = table.update_item(
+            Key={'eventId': event_id},
+            UpdateExpression='SET mediaVariants = :variants, updatedAt = :updatedAt',
+            ConditionExpression='croppedFileKey = :key',
+            ExpressionAttributeValues={':variants': variants, ':key': cropped_file_key, ':updatedAt': updated_at()},
+            ReturnValues='ALL_NEW'
+        )['Attributes']['timelineName']
+        print(f"Recorded {len(variants)} variants on event {event_id}")
+        bump_version(timelines_table, timeline_name)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        print(f"Event {event_id} no longer references {cropped_file_key}, variants not recorded")
+    return {'eventId': event_id, 'variants': variants}
@@ -0,0 +1,141 @@
+import os
+import time
+import boto3
+from botocore.exceptions import ClientError
+from media_io import run_parallel
+from timeline_versions import INDEX_SETTLE_SECONDS
+from timeline_summary import MONTH_PREFIX, event_bytes
+
+s3_client = boto3.client('s3', region_name='eu-west-1')
+dynamodb = boto3.resource('dynamodb', region_name='eu-west-1')
+timelines_table = dynamodb.Table('Timelines')
+
+EVENTS_ID_INDEX = 'TimelineNameIndex'
+MAX_ATTEMPTS = 3
+
+def timeline_events(events_table, timeline_name):
+    query_kwargs = {
+        'IndexName': EVENTS_ID_INDEX,
+        'KeyConditionExpression': 'timelineName = :tn',
+        'FilterExpression': 'attribute_not_exists(deleted)',
+        'ExpressionAttributeValues': {':tn': timeline_name},
+        'ProjectionExpression': 'eventId, #date, originalFileKey, croppedFileKey, originalFileSize, croppedFileSize',
+        'ExpressionAttributeNames': {'#date': 'date'}
+    }
+    events = []
+    while True:
+        response = events_table.query(**query_kwargs)
+        events.extend(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            return events
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def fill_media_sizes(events_table, bucket_name, events):
+    # Events written before sizes were recorded get them from S3, and keep them
+    missing = {
+        (item['eventId'], kind): item[f'{kind}FileKey']
+        for item in events for kind in ['original', 'cropped']
+        if item.get(f'{kind}FileKey') and f'{kind}FileSize' not in item
+    }
+    found, _ = run_parallel({
+        name: (lambda key=key: s3_client.head_object(Bucket=bucket_name, Key=key))
+        for name, key in missing.items()
+    })
+    by_id = {item['eventId']: item for item in events}
+    for (event_id, kind), response in found.items():
+        by_id[event_id][f'{kind}FileSize'] = response['ContentLength']
+        try:
+            events_table.update_item(
+                Key={'eventId': event_id},
+                UpdateExpression=f'SET {kind}FileSize = :size',
+                ConditionExpression=f'{kind}FileKey = :key',
+                ExpressionAttributeValues={':size': response['ContentLength'], ':key': missing[(event_id, kind)]}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+def rebuild(events_table, bucket_name, timeline_name):
+    # Recounts from the events and writes the summary only if no event write
+    # bumped the version meanwhile; returns the new event count or None
+    for attempt in range(MAX_ATTEMPTS):
+        item = timelines_table.get_item(Key={'timelineName': timeline_name}, ConsistentRead=True).get('Item')
+        if not item or item.get('deletionStatus'):
+            return None
+        # Let the index catch up with the latest write before reading it
+        wait = int(item.get('eventsChangedAt', 0)) + INDEX_SETTLE_SECONDS - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        events = timeline_events(events_table, timeline_name)
+        fill_media_sizes(events_table, bucket_name, events)
+
+        months = {}
+        for event in events:
+            month = MONTH_PREFIX + event['date'][:7]
+            months[month] = months.get(month, 0) + 1
+        values = {
+            'eventCount': len(events),
+            'mediaBytes': sum(event_bytes(event) for event in events),
+            'summaryBuiltAt': int(time.time()),
+            **months
+        }
+        dates = [event['date'] for event in events]
+        if dates:
+            values.update(minDate=min(dates), maxDate=max(dates))
+        stale = [name for name in item if name.startswith(MONTH_PREFIX) and name not in months]
+        if not dates:
+            stale.extend(name for name in ['minDate', 'maxDate'] if name in item)
+
+        names = {f'#a{index}': name for index, name in enumerate(list(values) + stale)}
+        update_expression = 'SET ' + ', '.join(f'#a{index} = :a{index}' for index in range(len(values)))
+        if stale:
+            update_expression += ' REMOVE ' + ', '.join(f'#a{index}' for index in range(len(values), len(names)))
+        expression_values = {f':a{index}': value for index, value in enumerate(values.values())}
+        if 'eventsVersion' in item:
+            condition = 'eventsVersion = :version'
+            expression_values[':version'] = item['eventsVersion']
+        else:
+            condition = 'attribute_exists(timelineName) AND attribute_not_exists(eventsVersion)'
+        try:
+            timelines_table.update_item(
+                Key={'timelineName': timeline_name},
+                UpdateExpression=update_expression,
+                ConditionExpression=condition,
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=expression_values
+            )
+            return len(events)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            print(f"Timeline {timeline_name} changed during rebuild (attempt {attempt + 1}), retrying")
+    return None
+
+# Recomputes the summary GET /timelines?summary=true returns (see
+# timeline_summary) from the events themselves. Runs daily to correct any drift
+# and to cover events written before summaries existed; invoke with
+# {"timelineName": "..."} to rebuild a single timeline.
+def lambda_handler(event, context):
+    bucket_name = os.environ.get('MEDIA_BUCKET', 'evidence-timeline-media')
+    events_table = dynamodb.Table(os.environ.get('EVENTS_TABLE', 'TimelineEvents'))
+    names = [(event or {})['timelineName']] if (event or {}).get('timelineName') else None
+    if names is None:
+        names = []
+        scan_kwargs = {'ProjectionExpression': 'timelineName'}
+        while True:
+            response = timelines_table.scan(**scan_kwargs)
+            names.extend(item['timelineName'] for item in response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                break
+            scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    report = {'rebuilt': 0, 'skipped': []}
+    for timeline_name in names:
+        count = rebuild(events_table, bucket_name, timeline_name)
+        if count is None:
+            report['skipped'].append(timeline_name)
+            continue
+        report['rebuilt'] += 1
+        print(f"Rebuilt summary of {timeline_name}: {count} events")
+    print(f"Rebuilt {report['rebuilt']} timeline summaries, skipped {len(report['skipped'])}")
+    return report
@@ -0,0 +1,106 @@
+import os
+import time
+import boto3
+from datetime import datetime, timedelta, timezone
+from botocore.exceptions import ClientError
+
+s3_client = boto3.client('s3', region_name='eu-west-1')
+dynamodb = boto3.resource('dynamodb', region_name='eu-west-1')
+
+MEDIA_PREFIXES = ['events/original/', 'events/cropped/', 'events/variants/']
+DELETE_BATCH_SIZE = 1000  # DeleteObjects limit
+REPORT_SAMPLE_SIZE = 100
+
+def referenced_keys(events_table, media_index_table):
+    # Every key an event points at, plus anything the media index still counts
+    # as referenced (so a deduplicated upload is never removed under it)
+    keys = set()
+    scan_kwargs = {
+        'ProjectionExpression': 'originalFileKey, croppedFileKey, mediaVariants'
+    }
+    while True:
+        response = events_table.scan(**scan_kwargs)
+        for item in response.get('Items', []):
+            keys.update(key for key in [item.get('originalFileKey'), item.get('croppedFileKey')] if key)
+            for variant in item.get('mediaVariants', []):
+                keys.update(key for key in [variant.get('webp'), variant.get('jpeg')] if key)
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    scan_kwargs = {
+        'ProjectionExpression': 'mediaKey, refCount'
+    }
+    while True:
+        response = media_index_table.scan(**scan_kwargs)
+        keys.update(item['mediaKey'] for item in response.get('Items', []) if item.get('refCount', 0) > 0)
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return keys
+
+def delete_batch(bucket_name, keys, report):
+    try:
+        response = s3_client.delete_objects(
+            Bucket=bucket_name,
+            Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True}
+        )
+    except ClientError as e:
+        report['failed'].extend(keys)
+        print(f"Error deleting batch of {len(keys)} objects: {str(e)}")
+        return
+    errors = response.get('Errors', [])
+    report['deleted'] += len(keys) - len(errors)
+    for error in errors:
+        report['failed'].append(error['Key'])
+        print(f"Error deleting {error['Key']}: {error.get('Code')} - {error.get('Message')}")
+
+# Runs on a schedule and removes media objects that no event references any more
+# (replaced uploads, abandoned presigned uploads, variants of superseded images).
+# Objects younger than ORPHAN_GRACE_HOURS are left alone, since an upload is not
+# referenced until the event that uses it is saved. Invoke with {"dryRun": true}
+# to get the report without deleting anything.
+def lambda_handler(event, context):
+    bucket_name = os.environ.get('MEDIA_BUCKET', 'evidence-timeline-media')
+    events_table = dynamodb.Table(os.environ.get('EVENTS_TABLE', 'TimelineEvents'))
+    media_index_table = dynamodb.Table(os.environ.get('MEDIA_INDEX_TABLE', 'MediaIndex'))
+    grace_hours = float(os.environ.get('ORPHAN_GRACE_HOURS', '24'))
+    max_batches_per_second = float(os.environ.get('DELETE_BATCHES_PER_SECOND', '2'))
+    dry_run = bool((event or {}).get('dryRun')) or os.environ.get('DRY_RUN', '').lower() == 'true'
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=grace_hours)
+
+    referenced = referenced_keys(events_table, media_index_table)
+    print(f"{len(referenced)} media keys are referenced")
+
+    report = {'dryRun': dry_run, 'scanned': 0, 'orphaned': 0, 'orphanedBytes': 0, 'deleted': 0, 'failed': [], 'sample': []}
+    batch = []
+    last_batch_at = 0.0
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for prefix in MEDIA_PREFIXES:
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                report['scanned'] += 1
+                if obj['Key'] in referenced or obj['LastModified'] > cutoff:
+                    continue
+                report['orphaned'] += 1
+                report['orphanedBytes'] += obj['Size']
+                if len(report['sample']) < REPORT_SAMPLE_SIZE:
+                    report['sample'].append(obj['Key'])
+                if dry_run:
+                    continue
+                batch.append(obj['Key'])
+                if len(batch) == DELETE_BATCH_SIZE:
+                    # Rate limit so a large cleanup does not compete with user traffic
+                    wait = last_batch_at + 1 / max_batches_per_second - time.time()
+                    if wait > 0:
+                        time.sleep(wait)
+                    delete_batch(bucket_name, batch, report)
+                    last_batch_at = time.time()
+                    batch = []
+    if batch:
+        delete_batch(bucket_name, batch, report)
+
+    action = 'Found' if dry_run else 'Deleted'
+    count = report['orphaned'] if dry_run else report['deleted']
+    print(f"{action} {count} orphaned media objects ({report['orphanedBytes']} bytes) out of {report['scanned']}, {len(report['failed'])} failures")
+    return report
@@ -1,15 +1,22 @@
 import json
+import os
 import boto3
 import bcrypt
 from botocore.exceptions import ClientError
 from datetime import datetime
+from responses import request_body
 
 dynamodb = boto3.resource('dynamodb', region_name='eu-west-1')
 users_table = dynamodb.Table('Users')
+# One item per username (username -> email). Writing it in the same transaction
+# as the user makes usernames unique without a read first.
+usernames_table = dynamodb.Table(os.environ.get('USERNAMES_TABLE', 'Usernames'))
+# Set to "false" once BackfillUsernamesFunction has run without failures
+USERNAME_INDEX_CHECK = os.environ.get('USERNAME_INDEX_CHECK', 'true').lower() == 'true'
 
 def lambda_handler(event, context):
     try:
-        body = json.loads(event.get('body', '{}'))
+        body = json.loads(request_body(event))
         email = body.get('email', '').strip()
         username = body.get('username', '').strip()
         password = body.get('password', '').strip()
@@ -31,58 +38,85 @@ def lambda_handler(event, context):
                 'headers': headers
             }
 
-        # Check for existing email
-        try:
-            existing_email = users_table.get_item(Key={'email': email}).get('Item')
-            if existing_email:
+        # Users registered before the Usernames table existed only have an item
+        # there once BackfillUsernamesFunction has run; until then their
+        # usernames are found on the index (see USERNAME_INDEX_CHECK)
+        if USERNAME_INDEX_CHECK:
+            try:
+                response = users_table.query(
+                    IndexName='UsernameIndex',
+                    KeyConditionExpression='username = :username',
+                    ExpressionAttributeValues={':username': username}
+                )
+                if response.get('Items'):
+                    return {
+                        'statusCode': 409,
+                        'body': json.dumps({'error': 'Username already exists'}),
+                        'headers': headers
+                    }
+            except ClientError as e:
                 return {
-                    'statusCode': 409,
-                    'body': json.dumps({'error': 'Email already exists'}),
+                    'statusCode': 500,
+                    'body': json.dumps({'error': f'Failed to check username: {str(e)}'}),
                     'headers': headers
                 }
-        except ClientError as e:
-            return {
-                'statusCode': 500,
-                'body': json.dumps({'error': f'Failed to check email: {str(e)}'}),
-                'headers': headers
-            }
 
-        # Check for existing username
+        hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=10)).decode('utf-8')
+        now = datetime.utcnow().isoformat()
+
         try:
-            response = users_table.query(
-                IndexName='UsernameIndex',
-                KeyConditionExpression='username = :username',
-                ExpressionAttributeValues={':username': username}
-            )
-            if response.get('Items'):
+            dynamodb.meta.client.transact_write_items(TransactItems=[
+                {
+                    'Put': {
+                        'TableName': users_table.name,
+                        'Item': {
+                            'email': email,
+                            'username': username,
+                            'password': hashed_password,
+                            'firstName': firstName,
+                            'surname': surname,
+                            'role': 'viewer',
+                            'timelines': [],
+                            'requestTimeline': requestTimeline,
+                            'createdAt': now,
+                            'updatedAt': now
+                        },
+                        'ConditionExpression': 'attribute_not_exists(email)'
+                    }
+                },
+                {
+                    'Put': {
+                        'TableName': usernames_table.name,
+                        'Item': {'username': username, 'email': email, 'createdAt': now},
+                        'ConditionExpression': 'attribute_not_exists(username)'
+                    }
+                }
+            ])
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'TransactionCanceledException':
                 return {
-                    'statusCode': 409,
-                    'body': json.dumps({'error': 'Username already exists'}),
+                    'statusCode': 500,
+                    'body': json.dumps({'error': f'Failed to register user: {str(e)}'}),
+                    'headers': headers
+                }
+            # One reason per item, in TransactItems order
+            reasons = [reason.get('Code') for reason in e.response.get('CancellationReasons', [])]
+            if reasons[:1] == ['ConditionalCheckFailed']:
+                error = 'Email already exists'
+            elif reasons[1:2] == ['ConditionalCheckFailed']:
+                error = 'Username already exists'
+            else:
+                return {
+                    'statusCode': 500,
+                    'body': json.dumps({'error': f'Failed to register user: {str(e)}'}),
                     'headers': headers
                 }
-        except ClientError as e:
             return {
-                'statusCode': 500,
-                'body': json.dumps({'error': f'Failed to check username: {str(e)}'}),
+                'statusCode': 409,
+                'body': json.dumps({'error': error}),
                 'headers': headers
             }
 
-        hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=10)).decode('utf-8')
-        now = datetime.utcnow().isoformat()
-
-        users_table.put_item(Item={
-            'email': email,
-            'username': username,
-            'password': hashed_password,
-            'firstName': firstName,
-            'surname': surname,
-            'role': 'viewer',
-            'timelines': [],
-            'requestTimeline': requestTimeline,
-            'createdAt': now,
-            'updatedAt': now
-        })
-
         return {
             'statusCode': 201,
             'body': json.dumps({'message': f'User {email} registered successfully'}),
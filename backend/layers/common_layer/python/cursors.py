@@ -0,0 +1,35 @@
+# Opaque tokens handed to clients: base64url JSON without padding. A pagination
+# cursor carries the DynamoDB LastEvaluatedKey together with the scope of the
+# query that produced it (index, key condition, order), so a cursor replayed
+# against a different query is rejected with a 400 instead of reaching DynamoDB
+# as a start key it cannot use.
+import json
+import base64
+import hashlib
+
+def encode_token(payload):
+    raw = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('utf-8').rstrip('=')
+
+def decode_token(token):
+    # Raises ValueError for anything that is not a token this module made
+    padded = token + '=' * (-len(token) % 4)
+    payload = json.loads(base64.urlsafe_b64decode(padded.encode('utf-8')).decode('utf-8'))
+    if not isinstance(payload, dict):
+        raise ValueError("Token is not an object")
+    return payload
+
+def query_scope(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+def encode_cursor(last_evaluated_key, scope):
+    return encode_token({'k': last_evaluated_key, 's': scope})
+
+def decode_cursor(cursor, scope):
+    payload = decode_token(cursor)
+    key = payload.get('k')
+    if not isinstance(key, dict) or not key:
+        raise ValueError("Cursor does not contain a start key")
+    if payload.get('s') != scope:
+        raise ValueError("Cursor belongs to a different query")
+    return key
@@ -0,0 +1,88 @@
+# BatchWriteItem / BatchGetItem in chunks of the API limits, retrying the
+# unprocessed part of each response with exponential backoff, and
+# TransactWriteItems retried on conflicts. The batch helpers work on a boto3
+# Table resource, whose client (de)serializes plain Python values.
+import random
+import time
+from botocore.exceptions import ClientError
+
+BATCH_WRITE_LIMIT = 25
+BATCH_GET_LIMIT = 100
+MAX_BATCH_RETRIES = 8
+BACKOFF_BASE_SECONDS = 0.05
+BACKOFF_MAX_SECONDS = 2.0
+
+def backoff(attempt):
+    # Full jitter keeps concurrent writers from retrying in lockstep
+    time.sleep(random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt)))
+
+def batch_write(table, requests, before_send=None):
+    # requests are {'PutRequest': {'Item': ...}} or {'DeleteRequest': {'Key': ...}}.
+    # before_send, when given, is called with the requests of every call, retries
+    # included, right before it goes out. Returns the requests that were still
+    # not written after the retries.
+    client = table.meta.client
+    failed = []
+    for start in range(0, len(requests), BATCH_WRITE_LIMIT):
+        pending = requests[start:start + BATCH_WRITE_LIMIT]
+        for attempt in range(MAX_BATCH_RETRIES + 1):
+            if attempt:
+                backoff(attempt - 1)
+            if before_send:
+                before_send(pending)
+            try:
+                response = client.batch_write_item(RequestItems={table.name: pending})
+            except ClientError as e:
+                print(f"BatchWriteItem error (attempt {attempt + 1}): {str(e)}")
+                continue
+            pending = response.get('UnprocessedItems', {}).get(table.name, [])
+            if not pending:
+                break
+        if pending:
+            print(f"{len(pending)} writes still unprocessed after {MAX_BATCH_RETRIES} retries")
+            failed.extend(pending)
+    return failed
+
+def batch_get(table, keys, **options):
+    # options are per-table request fields such as ConsistentRead or
+    # ProjectionExpression. Returns (items, keys that could not be read after the
+    # retries); items come back in no particular order.
+    client = table.meta.client
+    items = []
+    failed = []
+    for start in range(0, len(keys), BATCH_GET_LIMIT):
+        request = dict(options, Keys=keys[start:start + BATCH_GET_LIMIT])
+        for attempt in range(MAX_BATCH_RETRIES + 1):
+            if attempt:
+                backoff(attempt - 1)
+            try:
+                response = client.batch_get_item(RequestItems={table.name: request})
+            except ClientError as e:
+                print(f"BatchGetItem error (attempt {attempt + 1}): {str(e)}")
+                continue
+            items.extend(response.get('Responses', {}).get(table.name, []))
+            unprocessed = response.get('UnprocessedKeys', {}).get(table.name)
+            if not unprocessed:
+                request = None
+                break
+            request = unprocessed
+        if request:
+            print(f"{len(request['Keys'])} reads still unprocessed after {MAX_BATCH_RETRIES} retries")
+            failed.extend(request['Keys'])
+    return items, failed
+
+def transact_write(client, actions):
+    # TransactWriteItems, retried with backoff while the only cancellation
+    # reasons are conflicts with concurrent writes to the same items (botocore
+    # does not retry those). Anything else, a failed condition included, is
+    # raised for the caller to read the CancellationReasons.
+    for attempt in range(MAX_BATCH_RETRIES + 1):
+        if attempt:
+            backoff(attempt - 1)
+        try:
+            return client.transact_write_items(TransactItems=actions)
+        except ClientError as e:
+            reasons = {reason.get('Code') for reason in e.response.get('CancellationReasons', [])} - {'None'}
+            if e.response['Error']['Code'] != 'TransactionCanceledException' or reasons != {'TransactionConflict'} or attempt == MAX_BATCH_RETRIES:
+                raise
+            print(f"TransactWriteItems conflicted (attempt {attempt + 1}), retrying")
@@ -0,0 +1,24 @@
+# Change tracking for delta sync (GET /events?since=...). Every write to an
+# event sets updatedAt, and a delete replaces the event with a tombstone that
+# DynamoDB TTL removes after TOMBSTONE_TTL_DAYS. TimelineUpdatedIndex is keyed on
+# timelineName + updatedAt; tombstones have no date, so they never show up in
+# TimelineDateIndex.
+import os
+import time
+from datetime import datetime
+
+TOMBSTONE_TTL_DAYS = int(os.environ.get('TOMBSTONE_TTL_DAYS', '30'))
+
+def updated_at():
+    # Millisecond precision ISO timestamps sort as strings
+    return datetime.utcnow().isoformat(timespec='milliseconds')
+
+def tombstone(event_id, timeline_name):
+    return {
+        'eventId': event_id,
+        'timelineName': timeline_name,
+        'deleted': True,
+        'updatedAt': updated_at(),
+        # Epoch seconds, the table's TTL attribute
+        'expiresAt': int(time.time()) + TOMBSTONE_TTL_DAYS * 86400
+    }
@@ -0,0 +1,58 @@
+# S3 calls for the media of one event (original, cropped, variants) made
+# together: puts run on a small thread pool and deletes go out as a single
+# DeleteObjects, so a request waits for the slowest call rather than the sum.
+# Failures are reported per key instead of aborting the rest of the calls.
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+MEDIA_IO_WORKERS = 4
+DELETE_OBJECTS_LIMIT = 1000
+
+def run_parallel(calls, workers=MEDIA_IO_WORKERS):
+    # calls maps a name to a zero-argument callable. Returns (results, errors),
+    # both keyed by name, with errors holding the exception message.
+    results = {}
+    errors = {}
+    if not calls:
+        return results, errors
+    with ThreadPoolExecutor(max_workers=min(workers, len(calls))) as pool:
+        futures = {name: pool.submit(call) for name, call in calls.items()}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                errors[name] = str(e)
+    return results, errors
+
+def put_objects(s3_client, bucket_name, objects):
+    # objects are put_object arguments (Key, Body, ContentType, ...) without Bucket.
+    # Returns {key: error} for the uploads that failed.
+    _, errors = run_parallel({
+        obj['Key']: (lambda obj=obj: s3_client.put_object(Bucket=bucket_name, **obj))
+        for obj in objects
+    })
+    for key, error in errors.items():
+        print(f"Error uploading {key}: {error}")
+    return errors
+
+def delete_objects(s3_client, bucket_name, keys):
+    # Returns (deleted keys, {key: error} for the ones S3 did not delete)
+    keys = list(dict.fromkeys(key for key in keys if key))
+    deleted = []
+    failed = {}
+    for start in range(0, len(keys), DELETE_OBJECTS_LIMIT):
+        chunk = keys[start:start + DELETE_OBJECTS_LIMIT]
+        try:
+            response = s3_client.delete_objects(
+                Bucket=bucket_name,
+                Delete={'Objects': [{'Key': key} for key in chunk], 'Quiet': True}
+            )
+        except ClientError as e:
+            failed.update({key: str(e) for key in chunk})
+            continue
+        chunk_failed = {error['Key']: f"{error.get('Code')}: {error.get('Message')}" for error in response.get('Errors', [])}
+        failed.update(chunk_failed)
+        deleted.extend(key for key in chunk if key not in chunk_failed)
+    for key, error in failed.items():
+        print(f"Error deleting {key}: {error}")
+    return deleted, failed
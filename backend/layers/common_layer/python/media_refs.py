@@ -0,0 +1,83 @@
+# Reference counting for media objects in the MEDIA_INDEX_TABLE.
+# Media committed through presigned or multipart uploads is tracked here, and
+# uploads named by their SHA-256 can be shared by any number of events. Callers
+# delete an object from S3 only once drop_reference reports nothing references it.
+# Keys that were never indexed (written by the legacy base64 path) belong to a
+# single event.
+import os
+import time
+import boto3
+from botocore.exceptions import ClientError
+
+dynamodb = boto3.resource('dynamodb', region_name='eu-west-1')
+media_index_table = dynamodb.Table(os.environ.get('MEDIA_INDEX_TABLE', 'MediaIndex'))
+# Callers run these on run_parallel's threads. The Table resource is not
+# thread-safe; its low-level client is and still takes plain Python values.
+media_index = media_index_table.meta.client
+
+def find_media(key):
+    # Index item for a key that is still referenced, or None
+    item = media_index.get_item(TableName=media_index_table.name, Key={'mediaKey': key}).get('Item')
+    if item and item.get('refCount', 0) > 0:
+        return item
+    return None
+
+def acquire_media(key, count=1):
+    ref_count = media_index.update_item(
+        TableName=media_index_table.name,
+        Key={'mediaKey': key},
+        UpdateExpression='ADD refCount :count SET updatedAt = :now',
+        ExpressionAttributeValues={':count': count, ':now': int(time.time())},
+        ReturnValues='UPDATED_NEW'
+    )['Attributes']['refCount']
+    print(f"Media {key} now has {ref_count} references")
+    return ref_count
+
+def drop_reference(key):
+    # Drops one reference. Returns True when nothing references the object any
+    # more and the caller should delete it from S3.
+    try:
+        ref_count = media_index.update_item(
+            TableName=media_index_table.name,
+            Key={'mediaKey': key},
+            UpdateExpression='ADD refCount :minus_one',
+            ConditionExpression='attribute_exists(mediaKey)',
+            ExpressionAttributeValues={':minus_one': -1},
+            ReturnValues='UPDATED_NEW'
+        )['Attributes']['refCount']
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        # Not indexed: only this event ever referenced it
+        print(f"Media {key} is not indexed, no references left")
+        return True
+
+    if ref_count > 0:
+        print(f"Media {key} still has {ref_count} references, kept")
+        return False
+    try:
+        # Remove the index item first, and only if nobody re-acquired the key meanwhile
+        media_index.delete_item(
+            TableName=media_index_table.name,
+            Key={'mediaKey': key},
+            ConditionExpression='refCount <= :zero',
+            ExpressionAttributeValues={':zero': 0}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            print(f"Media {key} was referenced again, kept")
+            return False
+        raise
+    print(f"Media {key} has no references left")
+    return True
+
+def release_event_media(item):
+    # Drops the references an event item holds on its original and cropped
+    # images. Returns the S3 keys nothing references any more; variants are
+    # shared along with the cropped image, so they are among them when it is.
+    cropped_file_key = item.get('croppedFileKey')
+    unreferenced = [key for key in [item.get('originalFileKey'), cropped_file_key] if key and drop_reference(key)]
+    if cropped_file_key and cropped_file_key in unreferenced:
+        for variant in item.get('mediaVariants', []):
+            unreferenced.extend(variant[extension] for extension in ['webp', 'jpeg'] if variant.get(extension))
+    return unreferenced
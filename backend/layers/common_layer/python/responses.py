@@ -0,0 +1,71 @@
+# Compression of API Gateway proxy responses. Bodies above COMPRESSION_MIN_BYTES
+# are gzip (or brotli, when a layer provides the module) encoded as negotiated
+# from Accept-Encoding and returned base64 encoded with isBase64Encoded, which
+# API Gateway passes through as binary when the API's binary media types
+# include */*. With that setting API Gateway also hands request bodies over
+# base64 encoded, so every handler reads its body through request_body.
+import os
+import gzip
+import base64
+
+try:
+    import brotli
+except ImportError:
+    # Not part of the Lambda runtime; gzip is always available
+    brotli = None
+
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', '1024'))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', '6'))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', '5'))
+
+def request_body(event, default='{}'):
+    # The request body as text, or default when there is none
+    body = event.get('body')
+    if body is None:
+        return default
+    if event.get('isBase64Encoded'):
+        return base64.b64decode(body).decode('utf-8')
+    return body
+
+def _header(request_headers, name):
+    for key, value in (request_headers or {}).items():
+        if key.lower() == name.lower():
+            return value or ''
+    return ''
+
+def choose_encoding(request_headers):
+    # Highest q-value wins, brotli before gzip on a tie; "*" covers both
+    weights = {}
+    for part in _header(request_headers, 'Accept-Encoding').split(','):
+        coding, _, params = part.strip().lower().partition(';')
+        q = 1.0
+        if params.strip().startswith('q='):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if coding:
+            weights[coding.strip()] = q
+    candidates = (['br'] if brotli else []) + ['gzip']
+    ranked = [(weights.get(coding, weights.get('*', 0.0)), -rank, coding) for rank, coding in enumerate(candidates)]
+    q, _, coding = max(ranked)
+    return coding if q > 0 else None
+
+def compress_response(response, request_headers):
+    body = response.get('body')
+    if not isinstance(body, str) or response.get('isBase64Encoded'):
+        return response
+    raw = body.encode('utf-8')
+    if len(raw) < COMPRESSION_MIN_BYTES:
+        return response
+    headers = dict(response.get('headers') or {}, Vary='Accept-Encoding')
+    coding = choose_encoding(request_headers)
+    if not coding:
+        return dict(response, headers=headers)
+    if coding == 'br':
+        compressed = brotli.compress(raw, quality=BROTLI_QUALITY)
+    else:
+        # mtime=0 keeps the output identical for identical bodies
+        compressed = gzip.compress(raw, compresslevel=GZIP_LEVEL, mtime=0)
+    headers['Content-Encoding'] = coding
+    return dict(response, body=base64.b64encode(compressed).decode('ascii'), isBase64Encoded=True, headers=headers)
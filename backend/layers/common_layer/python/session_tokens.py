@@ -0,0 +1,113 @@
+# Compact HMAC-signed session tokens issued by LoginFunction.
+# A token is base64url(JSON claims) + "." + base64url(HMAC-SHA256 signature) and
+# carries the email, role, timelines, permissions version and expiry, so handlers
+# can authorize a request without reading the Users table. Tokens that are expired,
+# badly signed or older than a permissionsVersion this container has already seen
+# are treated as absent and the handler falls back to get_user().
+import os
+import json
+import hmac
+import time
+import base64
+import hashlib
+from user_cache import user_cache, get_user
+
+SESSION_TOKEN_SECRET = os.environ.get('SESSION_TOKEN_SECRET', '')
+SESSION_TOKEN_TTL_SECONDS = int(os.environ.get('SESSION_TOKEN_TTL_SECONDS', '900'))
+SESSION_TOKEN_HEADER = 'X-Session-Token'
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).decode('utf-8').rstrip('=')
+
+def _b64decode(value):
+    return base64.urlsafe_b64decode((value + '=' * (-len(value) % 4)).encode('utf-8'))
+
+def _sign(payload):
+    return hmac.new(SESSION_TOKEN_SECRET.encode('utf-8'), payload.encode('utf-8'), hashlib.sha256).digest()
+
+def issue_token(user, now=None):
+    if not SESSION_TOKEN_SECRET:
+        print("SESSION_TOKEN_SECRET not set, session tokens disabled")
+        return None, None
+    expires_at = int(now if now is not None else time.time()) + SESSION_TOKEN_TTL_SECONDS
+    claims = {
+        'email': user['email'],
+        'role': user.get('role', 'viewer'),
+        'timelines': list(user.get('timelines', [])),
+        'pv': int(user.get('permissionsVersion', 0)),
+        'exp': expires_at
+    }
+    payload = _b64encode(json.dumps(claims, separators=(',', ':')).encode('utf-8'))
+    return f"{payload}.{_b64encode(_sign(payload))}", expires_at
+
+def verify_token(token, now=None):
+    if not SESSION_TOKEN_SECRET or not token or token.count('.') != 1:
+        return None
+    payload, signature = token.split('.')
+    try:
+        if not hmac.compare_digest(_sign(payload), _b64decode(signature)):
+            return None
+        claims = json.loads(_b64decode(payload).decode('utf-8'))
+    except ValueError:
+        return None
+    if not isinstance(claims, dict) or claims.get('exp', 0) <= (now if now is not None else time.time()):
+        return None
+    return claims
+
+def user_from_token(request_headers):
+    # Returns a user dict shaped like get_user() output, or None when the caller must be looked up
+    if not isinstance(request_headers, dict):
+        return None
+    authorization = request_headers.get('Authorization', request_headers.get('authorization', ''))
+    if not authorization.startswith('Bearer '):
+        return None
+    claims = verify_token(authorization[len('Bearer '):].strip())
+    if not claims:
+        return None
+    cached = user_cache.peek(claims['email'])
+    if cached and int(cached.get('permissionsVersion', 0)) > claims['pv']:
+        print("Stale session token for:", claims['email'])
+        return None
+    return {
+        'email': claims['email'],
+        'role': claims['role'],
+        'timelines': claims['timelines'],
+        'permissionsVersion': claims['pv']
+    }
+
+def refreshed_token_headers(user):
+    # Response headers handing a fresh token to a caller that fell back to the Users table
+    token, _ = issue_token(user)
+    if not token:
+        return {}
+    return {
+        SESSION_TOKEN_HEADER: token,
+        'Access-Control-Expose-Headers': SESSION_TOKEN_HEADER
+    }
+
+class AuthenticationError(Exception):
+    # status_code is 400 when the request names no user, 401 for an unknown user
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+def authenticate(event, users_table, refresh=False):
+    # Returns (user, headers to add to the response). A fresh session token
+    # authorizes the request without a Users read; otherwise the X-Auth-Email user
+    # is looked up and handed a new token. refresh skips the token and the cache.
+    request_headers = event.get('headers') if isinstance(event.get('headers'), dict) else {}
+    token_user = None if refresh else user_from_token(request_headers)
+    if token_user:
+        print("User cache (token used):", user_cache.stats())
+        return token_user, {}
+    auth_email = request_headers.get('X-Auth-Email', request_headers.get('x-auth-email', '')).strip()
+    if not auth_email:
+        print("Missing X-Auth-Email header")
+        raise AuthenticationError(400, 'Missing X-Auth-Email header')
+    user = get_user(users_table, auth_email, refresh=refresh)
+    # Once per invocation, so hit rates can be read from the logs
+    print("User cache:", user_cache.stats())
+    if not user:
+        print("User not found for email:", auth_email)
+        raise AuthenticationError(401, 'User not found')
+    return user, refreshed_token_headers(user)
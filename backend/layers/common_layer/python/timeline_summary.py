@@ -0,0 +1,118 @@
+# Per-timeline summary kept on the Timelines item next to eventsVersion, so
+# GET /timelines can describe a timeline without reading its events:
+# eventCount, mediaBytes, minDate/maxDate and one month_YYYY-MM counter per month
+# with events. Counters change with atomic ADDs in the same update that bumps the
+# version; the date span only widens through conditional updates and is looked
+# up again on the date index when an event at either end goes away.
+# RebuildTimelineSummaryFunction recomputes everything daily, which also covers
+# events written before the summary existed. Until it has (summaryBuiltAt, also
+# set for timelines created with an empty summary) the counters only hold the
+# changes since, so no summary is shown for the timeline.
+import os
+from datetime import datetime
+from botocore.exceptions import ClientError
+from timeline_versions import bump_version
+
+EVENTS_DATE_INDEX = os.environ.get('EVENTS_DATE_INDEX', 'TimelineDateIndex')
+MONTH_PREFIX = 'month_'
+
+def event_bytes(item):
+    return int(item.get('originalFileSize', 0)) + int(item.get('croppedFileSize', 0))
+
+def _widen(timelines_table, timeline_name, attribute, date, comparison):
+    try:
+        timelines_table.update_item(
+            Key={'timelineName': timeline_name},
+            UpdateExpression=f'SET {attribute} = :date',
+            ConditionExpression=f'attribute_exists(timelineName) AND (attribute_not_exists({attribute}) OR {attribute} {comparison} :date)',
+            ExpressionAttributeValues={':date': date}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+def _edge_date(events_table, timeline_name, ascending, skip_ids):
+    # First date on the index that does not belong to a removed event; the index
+    # may lag behind, so the removed events can still show up in it
+    response = events_table.query(
+        IndexName=EVENTS_DATE_INDEX,
+        KeyConditionExpression='timelineName = :tn',
+        ExpressionAttributeValues={':tn': timeline_name},
+        ProjectionExpression='eventId, #date',
+        ExpressionAttributeNames={'#date': 'date'},
+        ScanIndexForward=ascending,
+        Limit=len(skip_ids) + 1
+    )
+    dates = [item['date'] for item in response.get('Items', []) if item['eventId'] not in skip_ids]
+    return dates[0] if dates else None
+
+def summary_counters(added=(), removed=()):
+    # added and removed are event items (eventId, date, media sizes); an edit is
+    # its old item removed and its new one added
+    counters = {
+        'eventCount': len(added) - len(removed),
+        'mediaBytes': sum(event_bytes(item) for item in added) - sum(event_bytes(item) for item in removed)
+    }
+    for item, step in [(item, 1) for item in added] + [(item, -1) for item in removed]:
+        month = MONTH_PREFIX + item['date'][:7]
+        counters[month] = counters.get(month, 0) + step
+    return counters
+
+def record_changes(timelines_table, events_table, timeline_name, added=(), removed=()):
+    # Applies the counters with the version bump, then the date span
+    summary = bump_version(timelines_table, timeline_name, summary_counters(added, removed))
+    if summary is not None:
+        update_date_span(timelines_table, events_table, timeline_name, summary, added, removed)
+
+def update_date_span(timelines_table, events_table, timeline_name, summary, added=(), removed=()):
+    # summary is the Timelines item after the counters were applied, or None
+    # when they went out in a transaction, which cannot return it; then only
+    # added events can widen the span
+    try:
+        if summary is not None and int(summary.get('eventCount', 0)) <= 0:
+            timelines_table.update_item(
+                Key={'timelineName': timeline_name},
+                UpdateExpression='REMOVE minDate, maxDate',
+                ConditionExpression='attribute_exists(timelineName) AND eventCount <= :zero',
+                ExpressionAttributeValues={':zero': 0}
+            )
+            return
+        summary = summary or {}
+        added_dates = [item['date'] for item in added]
+        removed_ids = {item['eventId'] for item in removed}
+        for attribute, ascending, comparison, pick in [('minDate', True, '>', min), ('maxDate', False, '<', max)]:
+            current = summary.get(attribute)
+            if current and any(item['date'] == current for item in removed):
+                # The event at this end is gone; find the new end on the index
+                candidates = [date for date in [_edge_date(events_table, timeline_name, ascending, removed_ids)] + added_dates if date]
+                if candidates:
+                    timelines_table.update_item(
+                        Key={'timelineName': timeline_name},
+                        UpdateExpression=f'SET {attribute} = :date',
+                        ConditionExpression='attribute_exists(timelineName)',
+                        ExpressionAttributeValues={':date': pick(candidates)}
+                    )
+            elif added_dates and (not current or pick(added_dates + [current]) != current):
+                _widen(timelines_table, timeline_name, attribute, pick(added_dates), comparison)
+    except ClientError as e:
+        # Left for the daily rebuild
+        print(f"Could not update date span of timeline {timeline_name}: {str(e)}")
+
+def summary_from_item(item):
+    # None until the summary has been built; counters are clamped at zero, as a
+    # delete racing the rebuild can leave them briefly below
+    if 'summaryBuiltAt' not in item:
+        return None
+    changed_at = item.get('eventsChangedAt')
+    return {
+        'eventCount': max(0, int(item.get('eventCount', 0))),
+        'mediaBytes': max(0, int(item.get('mediaBytes', 0))),
+        'minDate': item.get('minDate'),
+        'maxDate': item.get('maxDate'),
+        'months': {
+            name[len(MONTH_PREFIX):]: int(value)
+            for name, value in sorted(item.items())
+            if name.startswith(MONTH_PREFIX) and int(value) > 0
+        },
+        'lastModified': datetime.utcfromtimestamp(int(changed_at)).isoformat() if changed_at else None
+    }
@@ -0,0 +1,92 @@
+# Per-timeline version for conditional GETs. Every event write bumps
+# eventsVersion on the Timelines item, in the same transaction as the event or
+# right after it, so GET /events can answer If-None-Match with one get_item
+# instead of a query.
+import json
+import time
+import hashlib
+from botocore.exceptions import ClientError
+from dynamo_batch import MAX_BATCH_RETRIES, backoff
+
+# The event indexes are eventually consistent: for this long after a write a
+# query may still return the old data, so no ETag is handed out for it
+INDEX_SETTLE_SECONDS = 5
+
+def version_update(timeline_name, counters=None, live=False):
+    # The Timelines update that bumps the version; counters are more attributes
+    # to ADD in it (see timeline_summary). Keyword arguments for update_item, or
+    # with TableName an Update action of TransactWriteItems. live also requires
+    # the timeline not to be being deleted.
+    counters = {name: value for name, value in (counters or {}).items() if value}
+    names = {f'#c{index}': name for index, name in enumerate(counters)}
+    values = {f':c{index}': value for index, value in enumerate(counters.values())}
+    additions = ''.join(f', #c{index} :c{index}' for index in range(len(counters)))
+    update = {
+        'Key': {'timelineName': timeline_name},
+        'UpdateExpression': f'ADD eventsVersion :one{additions} SET eventsChangedAt = :now',
+        # Never create a Timelines item for a timeline that has none
+        'ConditionExpression': 'attribute_exists(timelineName)' + (' AND attribute_not_exists(deletionStatus)' if live else ''),
+        'ExpressionAttributeValues': {':one': 1, ':now': int(time.time()), **values}
+    }
+    if names:
+        update['ExpressionAttributeNames'] = names
+    return update
+
+def bump_version(timelines_table, timeline_name, counters=None):
+    # Returns the updated item, or None when the timeline has no Timelines item
+    # (reads of it never get an ETag). Conflicts with a transaction on the item
+    # are retried; any other failure is raised, since a lost bump would keep
+    # the old ETag valid for changed data.
+    update = version_update(timeline_name, counters)
+    for attempt in range(MAX_BATCH_RETRIES + 1):
+        if attempt:
+            backoff(attempt - 1)
+        try:
+            return timelines_table.update_item(ReturnValues='ALL_NEW', **update)['Attributes']
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code == 'ConditionalCheckFailedException':
+                print(f"Timeline {timeline_name} has no Timelines item, version not bumped")
+                return None
+            if code != 'TransactionConflictException' or attempt == MAX_BATCH_RETRIES:
+                raise
+            print(f"Version bump of {timeline_name} conflicted (attempt {attempt + 1}), retrying")
+
+def get_version(timelines_table, timeline_name):
+    # The timeline's version, or None while it is missing or still settling
+    item = timelines_table.get_item(
+        Key={'timelineName': timeline_name},
+        ConsistentRead=True,
+        ProjectionExpression='eventsVersion, eventsChangedAt'
+    ).get('Item')
+    if not item or time.time() - int(item.get('eventsChangedAt', 0)) < INDEX_SETTLE_SECONDS:
+        return None
+    return int(item.get('eventsVersion', 0))
+
+def make_etag(*parts, weak=False):
+    # Weak when equal versions may still differ in bytes (e.g. a fresh sync token)
+    digest = hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    return f'W/"{digest[:32]}"' if weak else f'"{digest[:32]}"'
+
+def _opaque(etag):
+    return etag[2:] if etag.startswith('W/') else etag
+
+def etag_matches(request_headers, etag):
+    # If-None-Match may list several ETags, or be "*"; it uses weak comparison
+    if not isinstance(request_headers, dict):
+        return False
+    value = request_headers.get('If-None-Match', request_headers.get('if-none-match', ''))
+    candidates = [candidate.strip() for candidate in value.split(',') if candidate.strip()]
+    return '*' in candidates or any(_opaque(candidate) == _opaque(etag) for candidate in candidates)
+
+def etag_headers(headers, etag):
+    # Browsers keep the body and revalidate it with If-None-Match on every use
+    exposed = headers.get('Access-Control-Expose-Headers')
+    return {
+        'ETag': etag,
+        'Cache-Control': 'private, no-cache',
+        'Access-Control-Expose-Headers': f'{exposed},ETag' if exposed else 'ETag'
+    }
+
+def not_modified(headers, etag):
+    return {'statusCode': 304, 'body': '', 'headers': dict(headers, **etag_headers(headers, etag))}
@@ -0,0 +1,37 @@
+# Event IDs and uploaded media keys are ULIDs: 48-bit millisecond timestamp
+# followed by 80 random bits, Crockford base32 encoded. They sort by creation
+# time, so they work as a range key for keyset pagination and "created since"
+# queries. Events created before ULIDs have 36-character UUIDs instead.
+import os
+import time
+
+ULID_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+ULID_LENGTH = 26
+ULID_RANDOM_BITS = 80
+_last_ulid = {"timestamp_ms": 0, "randomness": 0}
+
+def encode_ulid(value):
+    chars = []
+    for _ in range(ULID_LENGTH):
+        chars.append(ULID_ALPHABET[value & 0x1F])
+        value >>= 5
+    return "".join(reversed(chars))
+
+def new_ulid():
+    timestamp_ms = int(time.time() * 1000)
+    if timestamp_ms <= _last_ulid["timestamp_ms"]:
+        # Same millisecond (or clock went backwards) in this container: increment so IDs stay monotonic
+        timestamp_ms = _last_ulid["timestamp_ms"]
+        randomness = _last_ulid["randomness"] + 1
+        if randomness >= 1 << ULID_RANDOM_BITS:
+            timestamp_ms += 1
+            randomness = int.from_bytes(os.urandom(10), "big")
+    else:
+        randomness = int.from_bytes(os.urandom(10), "big")
+    _last_ulid["timestamp_ms"] = timestamp_ms
+    _last_ulid["randomness"] = randomness
+    return encode_ulid((timestamp_ms << ULID_RANDOM_BITS) | randomness)
+
+def ulid_lower_bound(timestamp_ms):
+    # Smallest ULID created at or after the given time
+    return encode_ulid(max(0, int(timestamp_ms)) << ULID_RANDOM_BITS)
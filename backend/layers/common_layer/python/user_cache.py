@@ -0,0 +1,80 @@
+# Shared by every handler through CommonLayer.
+# Caches the authorization fields of Users items in the Lambda container so warm
+# invocations skip the Users get_item. Entries expire after USER_CACHE_TTL_SECONDS;
+# writers bump permissionsVersion on the item and call invalidate() so the
+# container that made the change sees it immediately, and every other container
+# sees it within one TTL.
+import os
+import copy
+import time
+import threading
+from collections import OrderedDict
+
+USER_CACHE_TTL_SECONDS = float(os.environ.get('USER_CACHE_TTL_SECONDS', '30'))
+USER_CACHE_MAX_ENTRIES = int(os.environ.get('USER_CACHE_MAX_ENTRIES', '256'))
+CACHED_USER_FIELDS = ['email', 'username', 'role', 'timelines', 'permissionsVersion']
+
+class UserCache:
+    def __init__(self, ttl_seconds=USER_CACHE_TTL_SECONDS, max_entries=USER_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, users_table, email, refresh=False):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(email)
+            if entry and not refresh and entry[0] > now:
+                self._entries.move_to_end(email)
+                self.hits += 1
+                # Callers may mutate the result (e.g. append to timelines)
+                return copy.deepcopy(entry[1])
+            self.misses += 1
+
+        # A forced refresh follows a write, so it must not read a stale replica
+        item = users_table.get_item(Key={'email': email}, ConsistentRead=refresh).get('Item')
+        if not item:
+            # Missing users are not cached so a new registration is visible at once
+            self.invalidate(email)
+            return None
+        user = {field: item[field] for field in CACHED_USER_FIELDS if field in item}
+        self.put(email, user, now)
+        return copy.deepcopy(user)
+
+    def peek(self, email):
+        # Unexpired cached entry without touching LRU order or counters
+        with self._lock:
+            entry = self._entries.get(email)
+            if entry and entry[0] > time.monotonic():
+                return copy.deepcopy(entry[1])
+            return None
+
+    def put(self, email, user, now=None):
+        expires_at = (now if now is not None else time.monotonic()) + self.ttl_seconds
+        with self._lock:
+            self._entries[email] = (expires_at, user)
+            self._entries.move_to_end(email)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, email=None):
+        with self._lock:
+            if email is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(email, None)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+user_cache = UserCache()
+
+def get_user(users_table, email, refresh=False):
+    return user_cache.get(users_table, email, refresh=refresh)
+
+def invalidate_user(email=None):
+    user_cache.invalidate(email)
@@ -52,6 +52,10 @@ let currentUser = null;
 
 const API_ENDPOINT = "https://kx0nf3ttba.execute-api.eu-west-1.amazonaws.com/prod";
 const S3_MEDIA_URL = "https://evidence-timeline-media.s3.eu-west-1.amazonaws.com";
+const EVENTS_PAGE_SIZE = 200;
+const MULTIPART_THRESHOLD = 16 * 1024 * 1024;
+const MULTIPART_CONCURRENCY = 4;
+const IMAGE_SIZES = "(max-width: 600px) 100vw, 640px";
 
 function showLoadingSpinner() {
     if (loadingOverlay) {
@@ -86,26 +90,56 @@ function hideLoadingSpinner() {
     }
 }
 
-async function fetchTimelines() {
-    console.log("Fetching timelines with currentUser:", currentUser);
-    console.log("X-Auth-Email to be sent:", currentUser ? currentUser.email : "undefined");
+function authHeaders() {
     const headers = {
         "Content-Type": "application/json",
         "X-Auth-Email": currentUser ? currentUser.email : ""
     };
+    if (currentUser && currentUser.token) {
+        headers["Authorization"] = `Bearer ${currentUser.token}`;
+    }
+    return headers;
+}
+
+function rememberSessionToken(response) {
+    // Handlers send a fresh token whenever they had to fall back to the Users table
+    const token = response.headers.get("X-Session-Token");
+    if (token && currentUser) {
+        currentUser.token = token;
+        localStorage.setItem('user', JSON.stringify(currentUser));
+    }
+}
+
+async function fetchTimelines(refresh = false) {
+    console.log("Fetching timelines with currentUser:", currentUser);
+    console.log("X-Auth-Email to be sent:", currentUser ? currentUser.email : "undefined");
+    const headers = authHeaders();
+    if (refresh) {
+        // Skip the server-side user cache so a just-granted timeline shows up
+        headers["Cache-Control"] = "no-cache";
+    }
     console.log("Request headers:", headers);
     try {
-        const response = await fetch(`${API_ENDPOINT}/timelines`, {
-            method: "GET",
-            headers: headers,
-        });
-        console.log("Response status:", response.status, "Headers:", Object.fromEntries(response.headers));
-        if (!response.ok) {
-            const data = await response.json();
-            console.log("Error response:", data);
-            throw new Error(`HTTP error! Status: ${response.status}`);
-        }
-        const data = await response.json();
+        // Super admins get the full listing in pages; follow nextCursor to the end
+        const data = { timelines: [] };
+        let cursor = null;
+        do {
+            const url = cursor ? `${API_ENDPOINT}/timelines?cursor=${encodeURIComponent(cursor)}` : `${API_ENDPOINT}/timelines`;
+            const response = await fetch(url, {
+                method: "GET",
+                headers: headers,
+            });
+            rememberSessionToken(response);
+            console.log("Response status:", response.status, "Headers:", Object.fromEntries(response.headers));
+            if (!response.ok) {
+                const errorData = await response.json();
+                console.log("Error response:", errorData);
+                throw new Error(`HTTP error! Status: ${response.status}`);
+            }
+            const page = await response.json();
+            data.timelines.push(...(page.timelines || []));
+            cursor = page.nextCursor || null;
+        } while (cursor);
         console.log("Timelines data:", data);
         
         // Clear existing options
@@ -181,15 +215,13 @@ async function addTimeline() {
     try {
         const response = await fetch(`${API_ENDPOINT}/timelines`, {
             method: "POST",
-            headers: {
-                "Content-Type": "application/json",
-                "X-Auth-Email": currentUser.email
-            },
+            headers: authHeaders(),
             body: JSON.stringify({ timelineName: timelineName.trim() })
         });
+        rememberSessionToken(response);
         const data = await response.json();
         if (response.ok && data.message) {
-            await fetchTimelines();
+            await fetchTimelines(true);
             if (authError) authError.textContent = "Timeline added successfully.";
         } else {
             if (authError) authError.textContent = data.error || "Error adding timeline.";
@@ -207,6 +239,54 @@ function formatDate(dateStr) {
     return d.toLocaleDateString(undefined, { year: "numeric", month: "short", day: "numeric" });
 }
 
+// Events of the timeline on screen, kept up to date with delta syncs
+let timelineCache = null;
+
+async function fetchEventPages(timelineName, syncToken) {
+    // Follow nextCursor until the server reports no more pages; the sync token
+    // to use next time comes with the first page
+    const result = { events: [], deleted: [], syncToken: null };
+    let cursor = null;
+    do {
+        let url = `${API_ENDPOINT}/events?timelineName=${encodeURIComponent(timelineName)}&limit=${EVENTS_PAGE_SIZE}`;
+        if (syncToken) url += `&since=${encodeURIComponent(syncToken)}`;
+        if (cursor) url += `&cursor=${encodeURIComponent(cursor)}`;
+        const response = await fetch(url, {
+            method: "GET",
+            headers: authHeaders(),
+        });
+        rememberSessionToken(response);
+        if (response.status === 410) return null;
+        if (!response.ok) {
+            const data = await response.json();
+            throw new Error(`HTTP error! Status: ${response.status} ${data.error || response.statusText}`);
+        }
+        const data = await response.json();
+        result.events.push(...(data.events || []));
+        result.deleted.push(...(data.deleted || []));
+        if (!cursor) result.syncToken = data.syncToken || null;
+        cursor = data.nextCursor || null;
+    } while (cursor);
+    return result;
+}
+
+async function fetchTimelineEvents(timelineName) {
+    // Only changes since the last load are downloaded; an expired sync token
+    // (null result) falls back to loading the whole timeline
+    let changes = null;
+    if (timelineCache && timelineCache.timelineName === timelineName && timelineCache.syncToken) {
+        changes = await fetchEventPages(timelineName, timelineCache.syncToken);
+    }
+    if (!changes) {
+        timelineCache = { timelineName, events: new Map(), syncToken: null };
+        changes = await fetchEventPages(timelineName, null);
+    }
+    changes.events.forEach(event => timelineCache.events.set(event.eventId, event));
+    changes.deleted.forEach(eventId => timelineCache.events.delete(eventId));
+    timelineCache.syncToken = changes.syncToken;
+    return [...timelineCache.events.values()].sort((a, b) => a.date.localeCompare(b.date));
+}
+
 async function renderTimeline() {
     if (!currentTimelineName) {
         if (timelineContainer) timelineContainer.innerHTML = "";
@@ -218,19 +298,7 @@ async function renderTimeline() {
     }
     showLoadingSpinner();
     try {
-        const response = await fetch(`${API_ENDPOINT}/events?timelineName=${encodeURIComponent(currentTimelineName)}`, {
-            method: "GET",
-            headers: {
-                "Content-Type": "application/json",
-                "X-Auth-Email": currentUser ? currentUser.email : ""
-            },
-        });
-        if (!response.ok) {
-            const data = await response.json();
-            throw new Error(`HTTP error! Status: ${response.status} ${data.error || response.statusText}`);
-        }
-        const data = await response.json();
-        const timelineEvents = data.events || [];
+        const timelineEvents = await fetchTimelineEvents(currentTimelineName);
         hideLoadingSpinner();
         if (timelineContainer) timelineContainer.innerHTML = "";
 
@@ -260,12 +328,14 @@ async function renderTimeline() {
                     const fileType = event.croppedFileKey.match(/\.(jpg|jpeg|png|ogg|mp3)$/i) ? 
                         (event.croppedFileKey.match(/\.(jpg|jpeg|png)$/i) ? "image" : "audio") : null;
                     if (fileType === "image") {
+                        // Media URLs are immutable; an edited image comes back under a new URL
+                        const fullImageUrl = event.croppedUrl || `${S3_MEDIA_URL}/${event.croppedFileKey}`;
                         const img = document.createElement("img");
-                        img.src = `${S3_MEDIA_URL}/${event.croppedFileKey}?t=${new Date().getTime()}`;
+                        img.src = fullImageUrl;
                         img.alt = "Event image";
                         img.addEventListener("click", () => {
                             if (overlayImage) {
-                                overlayImage.src = img.src;
+                                overlayImage.src = fullImageUrl;
                                 if (imageOverlay) imageOverlay.style.display = "flex";
                             }
                         });
@@ -273,11 +343,29 @@ async function renderTimeline() {
                             console.error(`Failed to load image: ${img.src}`);
                             img.style.display = "none";
                         };
-                        mediaContainer.appendChild(img);
+                        if (event.srcset) {
+                            // Let the browser pick a resized variant; the overlay still shows the full image
+                            const picture = document.createElement("picture");
+                            if (event.srcset.webp) {
+                                const source = document.createElement("source");
+                                source.type = "image/webp";
+                                source.srcset = event.srcset.webp;
+                                source.sizes = IMAGE_SIZES;
+                                picture.appendChild(source);
+                            }
+                            if (event.srcset.jpeg) {
+                                img.srcset = event.srcset.jpeg;
+                                img.sizes = IMAGE_SIZES;
+                            }
+                            picture.appendChild(img);
+                            mediaContainer.appendChild(picture);
+                        } else {
+                            mediaContainer.appendChild(img);
+                        }
                     } else if (fileType === "audio") {
                         const audio = document.createElement("audio");
                         audio.controls = true;
-                        audio.src = `${S3_MEDIA_URL}/${event.croppedFileKey}`;
+                        audio.src = event.croppedUrl || `${S3_MEDIA_URL}/${event.croppedFileKey}`;
                         audio.onerror = () => {
                             console.error(`Failed to load audio: ${audio.src}`);
                             audio.style.display = "none";
@@ -352,7 +440,8 @@ async function handleLogin(e) {
                 email: data.email, 
                 role: data.role, 
                 timelines: data.timelines, 
-                username: data.username 
+                username: data.username,
+                token: data.token
             };
             localStorage.setItem('user', JSON.stringify(currentUser));
             loginSuccess();
@@ -588,27 +677,13 @@ if (eventForm) {
         };
 
         if (croppedBlob || originalFile) {
-            const readFile = (file) => {
-                return new Promise((resolve, reject) => {
-                    const reader = new FileReader();
-                    reader.onload = () => resolve(reader.result);
-                    reader.onerror = () => reject(new Error(`Error reading file: ${file?.name}`));
-                    reader.readAsDataURL(file);
-                });
-            };
-
             try {
-                if (originalFile) {
-                    eventData.originalFile = await readFile(originalFile);
-                }
-                if (croppedBlob) {
-                    eventData.croppedFile = await readFile(croppedBlob);
-                }
+                Object.assign(eventData, await uploadMedia({ original: originalFile, cropped: croppedBlob }));
                 await sendEvent(eventData, eventId);
             } catch (error) {
-                console.error("Error reading files:", error);
+                console.error("Error uploading files:", error);
                 hideLoadingSpinner();
-                if (authError) authError.textContent = "Error reading files";
+                if (authError) authError.textContent = `Error uploading files: ${error.message}`;
             }
         } else {
             await sendEvent(eventData, eventId);
@@ -616,17 +691,133 @@ if (eventForm) {
     });
 }
 
+async function uploadMedia(files) {
+    // Large files go through multipart uploads; the rest use one presigned PUT each
+    const fileKeys = {};
+    const singleFiles = {};
+    for (const [kind, file] of Object.entries(files)) {
+        if (!file) continue;
+        if (file.size > MULTIPART_THRESHOLD) {
+            fileKeys[`${kind}FileKey`] = await uploadMultipart(kind, file);
+        } else {
+            singleFiles[kind] = file;
+        }
+    }
+    if (Object.keys(singleFiles).length === 0) return fileKeys;
+
+    // Ask the API for presigned URLs, then send the bytes straight to S3.
+    // Keys are content hashes, so files S3 already has are not sent again.
+    const request = { timelineName: currentTimelineName };
+    for (const [kind, file] of Object.entries(singleFiles)) {
+        request[`${kind}ContentType`] = file.type;
+        request[`${kind}Sha256`] = await sha256Hex(file);
+    }
+    const response = await fetch(`${API_ENDPOINT}/events/uploads`, {
+        method: "POST",
+        headers: authHeaders(),
+        body: JSON.stringify(request),
+    });
+    rememberSessionToken(response);
+    const data = await response.json();
+    if (!response.ok) {
+        throw new Error(data.error || `HTTP error! Status: ${response.status}`);
+    }
+    await Promise.all(Object.entries(data.uploads).map(async ([kind, upload]) => {
+        if (upload.exists) {
+            fileKeys[`${kind}FileKey`] = upload.key;
+            return;
+        }
+        const uploadResponse = await fetch(upload.url, {
+            method: "PUT",
+            headers: upload.headers,
+            body: singleFiles[kind],
+        });
+        if (!uploadResponse.ok) {
+            throw new Error(`Upload of ${kind} file failed with status ${uploadResponse.status}`);
+        }
+        fileKeys[`${kind}FileKey`] = upload.key;
+    }));
+    return fileKeys;
+}
+
+async function sha256Hex(file) {
+    const digest = await crypto.subtle.digest("SHA-256", await file.arrayBuffer());
+    return Array.from(new Uint8Array(digest), (byte) => byte.toString(16).padStart(2, "0")).join("");
+}
+
+async function postMultipart(action, payload) {
+    const response = await fetch(`${API_ENDPOINT}/events/uploads/multipart`, {
+        method: "POST",
+        headers: authHeaders(),
+        body: JSON.stringify({ action, timelineName: currentTimelineName, ...payload }),
+    });
+    rememberSessionToken(response);
+    const data = await response.json();
+    if (!response.ok) {
+        throw new Error(data.error || `HTTP error! Status: ${response.status}`);
+    }
+    return data;
+}
+
+async function uploadMultipart(kind, file, restarted = false) {
+    // The uploadId is remembered per file so a retry after a dropped connection
+    // only sends the parts S3 does not have yet
+    const resumeKey = `multipart:${currentTimelineName}:${kind}:${file.name}:${file.size}:${file.lastModified}`;
+    let upload = JSON.parse(localStorage.getItem(resumeKey) || "null");
+    if (!upload) {
+        upload = await postMultipart("initiate", { kind, contentType: file.type });
+        localStorage.setItem(resumeKey, JSON.stringify(upload));
+    }
+    const partCount = Math.ceil(file.size / upload.partSize);
+    const partNumbers = Array.from({ length: partCount }, (_, i) => i + 1);
+    let presigned;
+    try {
+        presigned = await postMultipart("parts", { uploadId: upload.uploadId, partNumbers });
+    } catch (error) {
+        // The upload expired or was aborted: start a new one
+        localStorage.removeItem(resumeKey);
+        if (restarted) throw error;
+        return uploadMultipart(kind, file, true);
+    }
+
+    const etags = {};
+    presigned.uploadedParts.forEach(part => {
+        etags[part.PartNumber] = part.ETag;
+    });
+    const pending = partNumbers.filter(partNumber => !etags[partNumber]);
+    const uploadParts = async () => {
+        while (pending.length > 0) {
+            const partNumber = pending.shift();
+            const start = (partNumber - 1) * upload.partSize;
+            const response = await fetch(presigned.urls[partNumber], {
+                method: "PUT",
+                body: file.slice(start, start + upload.partSize),
+            });
+            if (!response.ok) {
+                throw new Error(`Upload of part ${partNumber} failed with status ${response.status}`);
+            }
+            etags[partNumber] = response.headers.get("ETag");
+        }
+    };
+    await Promise.all(Array.from({ length: MULTIPART_CONCURRENCY }, uploadParts));
+
+    const parts = partNumbers.map(partNumber => ({ PartNumber: partNumber, ETag: etags[partNumber] }));
+    const completed = await postMultipart("complete", { uploadId: upload.uploadId, parts });
+    localStorage.removeItem(resumeKey);
+    return completed.key;
+}
+
 async function sendEvent(eventData, eventId) {
     try {
         showLoadingSpinner();
+        // Edits without new media only send the changed text fields
+        const hasMedia = eventData.originalFileKey || eventData.croppedFileKey;
         const response = await fetch(`${API_ENDPOINT}/events${eventId ? `/${eventId}` : ""}`, {
-            method: eventId ? "PUT" : "POST",
-            headers: {
-                "Content-Type": "application/json",
-                "X-Auth-Email": currentUser ? currentUser.email : ""
-            },
+            method: eventId ? (hasMedia ? "PUT" : "PATCH") : "POST",
+            headers: authHeaders(),
             body: JSON.stringify(eventData),
         });
+        rememberSessionToken(response);
         const data = await response.json();
         if (response.ok && (data.message === "Event added" || data.message === "Event updated")) {
             if (eventForm) {
@@ -688,7 +879,7 @@ async function editEvent(event) {
     currentCroppedFileKey = event.croppedFileKey;
     isEditingExistingImage = event.originalFileKey && event.originalFileKey.match(/\.(jpg|jpeg|png)$/i);
     if (isEditingExistingImage && cropperImage && cropperModal && cropperPlaceholder && cropperControls && cropConfirm) {
-        cropperImage.src = `${S3_MEDIA_URL}/${event.originalFileKey}?t=${new Date().getTime()}`;
+        cropperImage.src = event.originalUrl || `${S3_MEDIA_URL}/${event.originalFileKey}`;
         cropperModal.style.display = "block";
         cropperPlaceholder.style.display = "none";
         cropperImage.style.display = "block";
@@ -724,11 +915,9 @@ async function deleteEvent(eventId) {
     try {
         const response = await fetch(`${API_ENDPOINT}/events/${eventId}?timelineName=${encodeURIComponent(currentTimelineName)}`, {
             method: "DELETE",
-            headers: {
-                "Content-Type": "application/json",
-                "X-Auth-Email": currentUser ? currentUser.email : ""
-            },
+            headers: authHeaders(),
         });
+        rememberSessionToken(response);
         const data = await response.json();
         if (data.success) {
             renderTimeline();
@@ -791,6 +980,7 @@ if (logoutButton) {
         }
         isEditingExistingImage = false;
         currentTimelineName = null;
+        timelineCache = null;
         if (timelineSelect) timelineSelect.value = "";
         if (selectedTimelineDisplay) selectedTimelineDisplay.textContent = "No Timeline Selected";
         if (addTimelineButton) addTimelineButton.style.display = "none";